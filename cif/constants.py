@@ -24,6 +24,14 @@ STORE_WRITE_ADDR = os.getenv('CIF_STORE_WRITE_ADDR', STORE_WRITE_ADDR)
 STORE_WRITE_H_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'store_write_h.ipc'))
 STORE_WRITE_H_ADDR = os.getenv('CIF_STORE_WRITE_H_ADDR', STORE_WRITE_H_ADDR)
 
+# store readers hand their writes to the store writer here
+STORE_HANDOFF_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'store_handoff.ipc'))
+STORE_HANDOFF_ADDR = os.getenv('CIF_STORE_HANDOFF_ADDR', STORE_HANDOFF_ADDR)
+
+# the store writer publishes token changes here, readers drop them from their token caches
+STORE_INVALIDATE_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'store_invalidate.ipc'))
+STORE_INVALIDATE_ADDR = os.getenv('CIF_STORE_INVALIDATE_ADDR', STORE_INVALIDATE_ADDR)
+
 HUNTER_ADDR = 'ipc://{}'.format(os.path.join(RUNTIME_PATH, 'hunter.ipc'))
 HUNTER_ADDR = os.getenv('CIF_HUNTER_ADDR', HUNTER_ADDR)
 
@@ -38,6 +46,13 @@ GATHERER_SINK_ADDR = os.getenv('CIF_GATHERER_SINK_ADDR', GATHERER_SINK_ADDR)
 
 TOKEN_CACHE_DELAY = 5
 
+# seconds a token stays cached, tokens edited in another store process are picked up after this
+TOKEN_CACHE_TTL = int(os.getenv('CIF_TOKEN_CACHE_TTL', 60))
+TOKEN_CACHE_SIZE = int(os.getenv('CIF_TOKEN_CACHE_SIZE', 1024))
+
+# seconds an unknown token is remembered as unknown
+TOKEN_CACHE_NEGATIVE_TTL = int(os.getenv('CIF_TOKEN_CACHE_NEGATIVE_TTL', TOKEN_CACHE_DELAY))
+
 HUNTER_RESOLVER_TIMEOUT = os.getenv('CIF_HUNTER_RESOLVER_TIMEOUT', 5)
 
 FEEDS_DAYS = 60
@@ -56,6 +71,19 @@ ROUTER_STREAM_ENABLED = os.getenv('CIF_ROUTER_STREAM_ENABLED', False)
 ROUTER_WEBHOOKS_ADDR = os.getenv('CIF_ROUTER_WEBHOOK_ADDR', 'ipc://webhook.ipc')
 ROUTER_WEBHOOKS_ENABLED = os.getenv('CIF_ROUTER_WEBHOOKS_ENABLED', False)
 
+# per token, per message type token buckets (msgs/sec, burst), off (0) unless set here or in router.yml as
+# 'rate_limits: {default: {<mtype>: {rate: n, burst: n}}, tokens: {<token>: {<mtype>: {...}}}}'
+ROUTER_RATE_LIMITS = {
+    'indicators_search': {
+        'rate': float(os.getenv('CIF_ROUTER_RATE_SEARCH', 0)),
+        'burst': int(os.getenv('CIF_ROUTER_RATE_SEARCH_BURST', 200)),
+    },
+    'indicators_create': {
+        'rate': float(os.getenv('CIF_ROUTER_RATE_CREATE', 0)),
+        'burst': int(os.getenv('CIF_ROUTER_RATE_CREATE_BURST', 1000)),
+    },
+}
+
 ENABLED = os.getenv('CIF_HUNTER_ADVANCED', False)
 if ENABLED == '1':
     ENABLED = True
@@ -3,15 +3,18 @@ import arrow
 import re
 import traceback
 import copy
+import itertools
+import ujson as json
 import zmq
 
 from flask_restplus import Namespace, Resource, fields
-from flask import request, session, current_app
+from flask import request, session, current_app, Response
 
 from cif.constants import FEEDS_LIMIT, FEEDS_WHITELIST_LIMIT, \
     HTTPD_FEED_WHITELIST_CONFIDENCE, FEEDS_WHITELIST_DAYS
 from cifsdk.constants import ROUTER_ADDR, VALID_FILTERS
-from cifsdk.client.zmq import ZMQ as Client
+from cifsdk.client.zmq import ZMQ as Client, RCVTIMEO, SNDTIMEO, LINGER
+from cifsdk.msg import Msg
 from cifsdk.exceptions import AuthError, TimeoutError, InvalidSearch, \
     SubmissionFailed, CIFBusy
 
@@ -66,6 +69,51 @@ def feed_factory(name):
 
 logger = logging.getLogger('cif-httpd')
 
+
+def stream_search(token, filters):
+    # the store answers a streamed search with one envelope per chunk, until one comes back with more=false
+    context = zmq.Context.instance()
+    s = context.socket(zmq.DEALER)
+    s.RCVTIMEO = RCVTIMEO
+    s.SNDTIMEO = SNDTIMEO
+    s.setsockopt(zmq.LINGER, LINGER)
+
+    try:
+        s.connect(ROUTER_ADDR)
+        Msg(mtype=Msg.INDICATORS_SEARCH, token=token, data=json.dumps(dict(filters, stream='1'))).send(s)
+
+        while True:
+            data = json.loads(s.recv_multipart()[-1])
+
+            if data.get('status') != 'success':
+                if data.get('message') == 'unauthorized':
+                    raise AuthError()
+
+                if data.get('message') == 'busy':
+                    raise CIFBusy()
+
+                raise RuntimeError(data.get('message'))
+
+            if data.get('data'):
+                yield data['data']
+
+            if not data.get('more'):
+                return
+    finally:
+        s.close()
+
+
+def json_array(chunks):
+    sep = '['
+    for c in chunks:
+        if not c:
+            continue
+
+        yield sep + ','.join(json.dumps(i) for i in c)
+        sep = ','
+
+    yield '[]' if sep == '[' else ']'
+
 itypes = ['ipv4', 'ipv6', 'url', 'fqdn', 'sha1', 'sha256', 'sha512', 'email',
           'asn']
 
@@ -100,10 +148,16 @@ envelope = api.model('Envelope', {
 @api.route('/')
 class IndicatorList(Resource):
 
-    def _pull(self, filters):
+    def _pull(self, filters, stream=False):
         try:
-            with Client(ROUTER_ADDR, session['token']) as client:
-                r = client.indicators_search(filters)
+            if stream:
+                # the first chunk is read here so store errors still map to status codes
+                r = stream_search(session['token'], filters)
+                r = itertools.chain([next(r, [])], r)
+
+            else:
+                with Client(ROUTER_ADDR, session['token']) as client:
+                    r = client.indicators_search(filters)
 
         except InvalidSearch as e:
             return api.abort(400)
@@ -111,7 +165,7 @@ class IndicatorList(Resource):
         except AuthError as e:
             return api.abort(401)
 
-        except zmq.error.Again as e:
+        except (zmq.error.Again, CIFBusy) as e:
             return api.abort(503)
 
         except Exception as e:
@@ -126,7 +180,7 @@ class IndicatorList(Resource):
 
         return r
 
-    def _pull_feed(self, filters, agg=True):
+    def _pull_feed(self, filters, agg=True, stream=False):
         if agg and not filters.get('reported_at') and not filters.get('days') \
                 and not filters.get('hours'):
             if not filters.get('itype'):
@@ -167,7 +221,7 @@ class IndicatorList(Resource):
         if agg:
             return aggregate(self._pull(filters))
 
-        return self._pull(filters)
+        return self._pull(filters, stream=stream)
 
     def _pull_whitelist(self, filters={}):
         wl_filters = copy.deepcopy(filters)
@@ -196,6 +250,12 @@ class IndicatorList(Resource):
         if request.args.get('q'):
             filters['indicator'] = request.args.get('q')
 
+        if request.args.get('messages'):
+            filters['messages'] = request.args.get('messages')
+
+        if request.args.get('nocache'):
+            filters['nocache'] = request.args.get('nocache')
+
         if not filters.get('confidence') \
                 and not filters.get('no_feed', '0') == '1' \
                 and not filters.get('indicator'):
@@ -215,6 +275,8 @@ class IndicatorList(Resource):
     @api.param('days', 'Filter based on now - $days')
     @api.param('nofeed', 'Do not try to whitelist KNOWN whitelisted addresses (eg: 8.8.8.8)')
     @api.param('fmt', 'Return format, default csv [json|csv]')
+    @api.param('messages', 'Include indicator messages in the results (eg: 1|0)')
+    @api.param('nocache', "Skip the router's search cache (eg: 1|0)")
     @api.doc('list_indicators')
     def get(self):
         """List all indicators"""
@@ -244,9 +306,13 @@ class IndicatorList(Resource):
 
                 return rv, 200
 
-            else:
+            if 'text/plain' in request.headers.get('Accept', ''):
                 return self._pull_feed(filters, agg=False), 200
 
+            # relay the store's chunks as they arrive instead of building the whole result first
+            rv = self._pull_feed(filters, agg=False, stream=True)
+            return Response(json_array(rv), mimetype='application/json', direct_passthrough=True)
+
         f = feed_factory(filters['itype'])
 
         tags = set([filters.get('tags')])
@@ -14,6 +14,7 @@ from cif.constants import HUNTER_ADDR, HUNTER_SINK_ADDR
 from csirtg_indicator import Indicator
 from cifsdk.utils import setup_runtime_path, setup_logging, get_argument_parser, load_plugins, settings
 
+from cif.utils import unpack_batch
 from cif.utils.process import MyProcess
 import cif.hunter
 from cif.utils.manager import Manager as _Manager
@@ -25,6 +26,9 @@ ZMQ_HWM = 1000000
 EXCLUDE = os.environ.get('CIF_HUNTER_EXCLUDE', None)
 HUNTER_ADVANCED = os.getenv('CIF_HUNTER_ADVANCED', 0)
 
+# indicators below this aren't hunted, searches always are
+HUNTER_MIN_CONFIDENCE = int(os.getenv('CIF_HUNTER_MIN_CONFIDENCE', 1))
+
 CONFIG_PATH = os.environ.get('CIF_ROUTER_CONFIG_PATH', 'router.yml')
 if not os.path.isfile(CONFIG_PATH):
     CONFIG_PATH = os.environ.get('CIF_ROUTER_CONFIG_PATH', os.path.join(os.path.expanduser('~'), 'router.yml'))
@@ -52,6 +56,18 @@ class Manager(_Manager):
         self.socket.bind(HUNTER_ADDR)
 
 
+def below_min_confidence(data):
+    # indicators (records with an itype) only, a search's confidence is a filter (eg: '7,10'), those and
+    # anything else that isn't a number get hunted
+    if not data.get('itype'):
+        return False
+
+    try:
+        return float(data.get('confidence', 0)) < HUNTER_MIN_CONFIDENCE
+    except (TypeError, ValueError):
+        return False
+
+
 class Hunter(MyProcess):
     def __init__(self, token=TOKEN):
         MyProcess.__init__(self)
@@ -91,16 +107,19 @@ class Hunter(MyProcess):
             self.exclude[provider].add(tag)
 
     def _process_message(self, message):
-        data = message
-
-        data = json.loads(data[0])
+        for data in unpack_batch(message):
+            self._process(data)
 
+    def _process(self, data):
         if not isinstance(data, dict):
             return
 
         if not data.get('indicator'):
             return
 
+        if below_min_confidence(data):
+            return
+
         if data['indicator'] in ["", 'localhost', 'example.com']:
             return
 
@@ -10,14 +10,18 @@ from time import sleep
 import zmq
 from zmq import POLLIN as Z_POLLIN
 import os
+import re
 from pprint import pprint
 
 from cif.constants import ROUTER_ADDR, STORE_ADDR, HUNTER_ADDR,  \
-    RUNTIME_PATH, ROUTER_STREAM_ENABLED, ROUTER_WEBHOOKS_ENABLED
+    RUNTIME_PATH, ROUTER_STREAM_ENABLED, ROUTER_WEBHOOKS_ENABLED, ROUTER_RATE_LIMITS
 from cifsdk.constants import CONFIG_PATH
 from cifsdk.utils import setup_logging, setup_signals, setup_runtime_path, \
     settings
 from cif.utils import get_argument_parser
+from cif.utils.scheduler import Scheduler, InFlight
+from cif.utils.ratelimit import RateLimiter
+from cif.utils.cache import SearchCache
 
 
 import time
@@ -25,11 +29,10 @@ from cifsdk.msg import Msg
 from cif.gatherer import Manager as GathererManager
 from cif.streamer import Manager as StreamManager
 from cif.webhooks import Manager as WebhooksManager
-from cif.hunter import Manager as HunterManager
+from cif.hunter import Manager as HunterManager, HUNTER_MIN_CONFIDENCE
 from cif.store import Manager as StoreManager
 
 
-HUNTER_MIN_CONFIDENCE = 1
 HUNTER_THREADS = os.getenv('CIF_HUNTER_THREADS', 0)
 HUNTER_ADVANCED = os.getenv('CIF_HUNTER_ADVANCED', 0)
 GATHERER_THREADS = os.getenv('CIF_GATHERER_THREADS', 2)
@@ -40,11 +43,50 @@ ZMQ_HWM = 1000000
 ZMQ_SNDTIMEO = 5000
 ZMQ_RCVTIMEO = 5000
 
-FRONTEND_TIMEOUT = os.getenv('CIF_FRONTEND_TIMEOUT', 1)
-BACKEND_TIMEOUT = os.getenv('CIF_BACKEND_TIMEOUT', 1)
+# ms to block in poll when nothing is queued
+POLL_TIMEOUT = int(os.getenv('CIF_ROUTER_POLL_TIMEOUT', 100))
+
+# max messages read off a socket per tick, and queued per class before we stop reading (zmq buffers the rest)
+ROUTER_DRAIN = int(os.getenv('CIF_ROUTER_DRAIN', 100))
+ROUTER_QUEUE_MAX = int(os.getenv('CIF_ROUTER_QUEUE_MAX', 10000))
+
+# messages handled per class per tick, overridden by 'weights' in router.yml
+ROUTER_WEIGHTS = {
+    'search': int(os.getenv('CIF_ROUTER_WEIGHT_SEARCH', 8)),
+    'write': int(os.getenv('CIF_ROUTER_WEIGHT_WRITE', 4)),
+    'gatherer': int(os.getenv('CIF_ROUTER_WEIGHT_GATHERER', 4)),
+    'hunter': int(os.getenv('CIF_ROUTER_WEIGHT_HUNTER', 1)),
+}
+
+# unanswered requests allowed per downstream before clients get a busy reply (0 is no limit), overridden by
+# 'inflight' in router.yml. hunters never answer, their limit is the send hwm, past it hunting is skipped
+ROUTER_INFLIGHT = {
+    'gatherers': int(os.getenv('CIF_ROUTER_INFLIGHT_GATHERERS', 5000)),
+    'store_read': int(os.getenv('CIF_ROUTER_INFLIGHT_STORE_READ', 1000)),
+    'store_write': int(os.getenv('CIF_ROUTER_INFLIGHT_STORE_WRITE', 5000)),
+    'hunters': int(os.getenv('CIF_ROUTER_INFLIGHT_HUNTERS', 10000)),
+}
+
+# seconds before an unanswered request stops counting against its downstream
+ROUTER_INFLIGHT_TIMEOUT = int(os.getenv('CIF_ROUTER_INFLIGHT_TIMEOUT', 60))
+
+# indicators_search replies kept per (token, filters) for ttl seconds (0 turns it off) and dropped early when a
+# write touches their itype, overridden by 'cache: {ttl: n, size: n}' in router.yml. replies bigger than
+# ROUTER_CACHE_MAX_BYTES aren't kept
+ROUTER_CACHE = {
+    'ttl': int(os.getenv('CIF_ROUTER_CACHE_TTL', 30)),
+    'size': int(os.getenv('CIF_ROUTER_CACHE_SIZE', 512)),
+}
+ROUTER_CACHE_MAX_BYTES = int(os.getenv('CIF_ROUTER_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+
+# the itypes in a gatherer batch, without decoding it
+ITYPE_RE = re.compile(r'"itype":\s*"([\w.]+)"')
 
 HUNTER_TOKEN = os.getenv('CIF_HUNTER_TOKEN', None)
 
+# writes that don't come through the gatherers, they go to the store writer too
+STORE_WRITE_MTYPES = ['tokens_create', 'tokens_edit', 'tokens_delete', 'indicators_delete']
+
 STORE_DEFAULT = os.getenv('CIF_STORE_STORE', STORE_DEFAULT)
 STORE_NODES = os.getenv('CIF_STORE_NODES')
 
@@ -89,6 +131,30 @@ class Router(object):
         self.webhooks = None
         self.store = None
 
+        weights = dict(ROUTER_WEIGHTS)
+        if self.settings and self.settings.get('weights'):
+            weights.update(self.settings['weights'])
+
+        self.scheduler = Scheduler(weights, max_queue=ROUTER_QUEUE_MAX)
+
+        limits = dict(ROUTER_INFLIGHT)
+        if self.settings and self.settings.get('inflight'):
+            limits.update(self.settings['inflight'])
+
+        self.inflight = {k: InFlight(v, timeout=ROUTER_INFLIGHT_TIMEOUT) for k, v in limits.items()}
+        self.hunters_dropped = 0
+
+        rates = (self.settings or {}).get('rate_limits') or {}
+        self.rate_limits = RateLimiter(dict(ROUTER_RATE_LIMITS, **rates.get('default', {})),
+                                       tokens=rates.get('tokens'), exempt=[self.hunter_token])
+        self.throttled = 0
+
+        cache = dict(ROUTER_CACHE, **(self.settings or {}).get('cache', {}))
+        self.cache = None
+        if int(cache['ttl']):
+            self.cache = SearchCache(size=int(cache['size']), ttl=int(cache['ttl']), max_bytes=ROUTER_CACHE_MAX_BYTES,
+                                     max_pending=ROUTER_QUEUE_MAX)
+
         self.kwargs = kwargs
 
     def _init_webhooks(self):
@@ -114,6 +180,9 @@ class Router(object):
         logger.info('launching hunters...')
 
         self.hunters = HunterManager(self.context, threads)
+        if self.inflight['hunters'].limit:
+            self.hunters.socket.set_hwm(self.inflight['hunters'].limit)
+
         self.hunters.start()
 
     def _init_gatherers(self, **kwargs):
@@ -139,46 +208,131 @@ class Router(object):
 
     def _init_pollers(self):
         self.poller = zmq.Poller()
-        self.poller_backend = zmq.Poller()
 
-        # register the front end poller
-        self.poller.register(self.frontend_s, Z_POLLIN)
-        self.poller.register(self.store.socket, Z_POLLIN)
-        self.poller.register(self.store.s_write, Z_POLLIN)
-        self.poller.register(self.store.s_hunter_write, Z_POLLIN)
+        # store replies are relayed as soon as they come in
+        self.relays = {
+            self.store.socket: 'store_read',
+            self.store.s_write: 'store_write',
+            self.store.s_hunter_write: 'store_write',
+        }
 
-        # setup the backend..
-        self.poller_backend.register(self.gatherers.sink_s, Z_POLLIN)
+        for s in [self.frontend_s, self.gatherers.sink_s] + list(self.relays):
+            self.poller.register(s, Z_POLLIN)
 
         if self.hunters:
-            self.poller_backend.register(self.hunters.sink, Z_POLLIN)
+            self.poller.register(self.hunters.sink, Z_POLLIN)
 
-    def _poll_frontend(self):
-        items = dict(self.poller.poll(FRONTEND_TIMEOUT))
+    def _drain(self, s, n=ROUTER_DRAIN):
+        for _ in range(n):
+            if not s.poll(0, Z_POLLIN):
+                return
 
-        if items.get(self.frontend_s) == Z_POLLIN:
-            self.handle_message(self.frontend_s)
+            yield s
 
-        if items.get(self.store.socket) == Z_POLLIN:
-            Msg().recv(self.store.socket, relay=self.frontend_s)
+    def _classify(self, mtype):
+        if mtype == 'indicators_create' or mtype in STORE_WRITE_MTYPES:
+            return 'write'
 
-        if items.get(self.store.s_write) == Z_POLLIN:
-            Msg().recv(self.store.s_write, relay=self.frontend_s)
+        return 'search'
 
-        if items.get(self.store.s_hunter_write) == Z_POLLIN:
-            Msg().recv(self.store.s_hunter_write, relay=self.frontend_s)
+    def _poll(self):
+        # don't block while there's queued work
+        timeout = 0 if self.scheduler.pending() else POLL_TIMEOUT
+        items = dict(self.poller.poll(timeout))
 
-    def _poll_backend(self):
-        items = dict(self.poller_backend.poll(BACKEND_TIMEOUT))
+        for s, d in self.relays.items():
+            if s in items:
+                for _ in self._drain(s):
+                    self._relay(s, d)
 
-        if items.get(self.gatherers.sink_s) == Z_POLLIN:
-            self.handle_message_gatherer(self.gatherers.sink_s)
+        # front end messages are either searches or writes, stop reading when either queue is full
+        if self.frontend_s in items:
+            for _ in self._drain(self.frontend_s):
+                if self.scheduler.full('search') or self.scheduler.full('write'):
+                    break
 
-        if not self.hunters:
-            return
+                m = Msg().recv(self.frontend_s)
+                if self._throttle(*m):
+                    continue
+
+                self.scheduler.push(self._classify(m[2]), m)
+
+        if self.gatherers.sink_s in items:
+            for _ in self._drain(self.gatherers.sink_s):
+                if self.scheduler.full('gatherer'):
+                    break
+
+                self.scheduler.push('gatherer', Msg().recv(self.gatherers.sink_s))
 
-        if items.get(self.hunters.sink) == Z_POLLIN:
-            self.handle_message(self.hunters.sink)
+        if self.hunters and self.hunters.sink in items:
+            for _ in self._drain(self.hunters.sink):
+                if self.scheduler.full('hunter'):
+                    break
+
+                self.scheduler.push('hunter', Msg().recv(self.hunters.sink))
+
+    def _relay(self, s, downstream):
+        m = s.recv_multipart()
+        self.frontend_s.send_multipart(m)
+
+        # a streamed search is answered once its last chunk (more=false) goes back
+        more = m[-1].endswith(b'"more":true}')
+        if not more:
+            self.inflight[downstream].done()
+
+        if downstream == 'store_read' and self.cache:
+            self.cache.reply(m[0], m[-1], more=more)
+
+    def _throttle(self, id, token, mtype, data):
+        ok, b = self.rate_limits.check(token, mtype)
+        if ok:
+            return False
+
+        # same busy status the admission control sends (CIFBusy in cifsdk), plus when to come back
+        self.throttled += 1
+        rv = {'status': 'failed', 'message': 'busy', 'data': {
+            'remaining': b.remaining(), 'limit': b.burst, 'rate': b.rate, 'retry_after': b.retry_after()}}
+
+        Msg(id=id, mtype=mtype, data=json.dumps(rv)).send(self.frontend_s)
+        return True
+
+    def _busy(self, id, mtype, downstream):
+        logger.warning('{} busy, {} in flight'.format(downstream, len(self.inflight[downstream])))
+        Msg(id=id, mtype=mtype, data=json.dumps({'status': 'failed', 'message': 'busy'})).send(self.frontend_s)
+
+    def _send(self, downstream, s, id, mtype, token, data):
+        # admission control, the client gets an explicit busy instead of queueing up behind a backlog
+        if self.inflight[downstream].full():
+            self._busy(id, mtype, downstream)
+            return False
+
+        self.inflight[downstream].add()
+        Msg(id=id, mtype=mtype, token=token, data=data).send(s)
+        return True
+
+    def _send_hunters(self, data):
+        try:
+            self.hunters.socket.send_string(data, zmq.NOBLOCK)
+        except zmq.Again:
+            self.hunters_dropped += 1
+
+    def metrics(self):
+        return {
+            'inflight': {k: len(v) for k, v in self.inflight.items() if k != 'hunters'},
+            'limits': {k: v.limit for k, v in self.inflight.items()},
+            'rejected': {k: v.rejected for k, v in self.inflight.items()},
+            'hunters_dropped': self.hunters_dropped,
+            'throttled': self.throttled,
+            'queued': self.scheduler.depth(),
+            'cache': self.cache.metrics() if self.cache else {},
+        }
+
+    def _schedule(self):
+        for c, m in self.scheduler.round():
+            if c == 'gatherer':
+                self._handle_gatherer(*m)
+            else:
+                self._handle(*m)
 
     def _log_counter(self):
         self.count += 1
@@ -186,12 +340,14 @@ class Router(object):
             t = (time.time() - self.count_start)
             n = self.count / t
             logger.info('processing {} msgs per {} sec'.format(round(n, 2), round(t, 2)))
+            logger.info('router: {}'.format(self.metrics()))
             self.count = 0
             self.count_start = time.time()
 
     def handle_message(self, s):
-        id, token, mtype, data = Msg().recv(s)
+        self._handle(*Msg().recv(s))
 
+    def _handle(self, id, token, mtype, data):
         handler = self.handle_message_default
         if mtype in ['indicators_create', 'indicators_search']:
             handler = getattr(self, "handle_" + mtype)
@@ -205,45 +361,73 @@ class Router(object):
 
         self._log_counter()
 
-    def handle_message_default(self, id, mtype, token, data='[]'):
-        Msg(id=id, mtype=mtype, token=token, data=data).send(self.store.socket)
+    def handle_message_default(self, id, mtype, token, data='[]', cache=(None, None)):
+        if mtype in STORE_WRITE_MTYPES:
+            # deletes and token changes can touch anything cached
+            if self.cache:
+                self.cache.invalidate()
+
+            return self._send('store_write', self.store.s_write, id, mtype, token, data)
+
+        if not self._send('store_read', self.store.socket, id, mtype, token, data):
+            return False
+
+        if self.cache:
+            self.cache.wait(id, *cache)
+
+        return True
 
     def handle_message_gatherer(self, s):
-        id, token, mtype, data = Msg().recv(s)
+        self._handle_gatherer(*Msg().recv(s))
+
+    def _handle_gatherer(self, id, token, mtype, data):
+        self.inflight['gatherers'].done()
 
         sock = self.store.s_write
         if token == self.hunter_token:
             sock = self.store.s_hunter_write
 
-        Msg(id=id, mtype=mtype, token=token, data=data).send(sock)
-
-        if not self.hunters and not self.streamer and not self.webhooks:
+        if not self._send('store_write', sock, id, mtype, token, data):
             return
 
-        data = json.loads(data)
-        if isinstance(data, dict):
-            data = [data]
-
-        for d in data:
-            s = json.dumps(d)
+        # writes are queued in the store, until they land a search can still cache the old results (for up to ttl)
+        if self.cache:
+            self.cache.invalidate(ITYPE_RE.findall(data))
 
-            if self.streamer:
-                self.streamer.socket.send_multipart([s.encode('utf-8')])
+        # the batch goes out as it came in, one send per consumer, they split it (and hunters apply
+        # HUNTER_MIN_CONFIDENCE) on their side
+        if self.streamer:
+            self.streamer.socket.send_string(data)
 
-            if self.webhooks:
-                self.webhooks.socket.send_string(s)
+        if self.webhooks:
+            self.webhooks.socket.send_string(data)
 
-            if self.hunters and int(d.get('confidence', 0)) \
-                    >= HUNTER_MIN_CONFIDENCE:
-                self.hunters.socket.send_string(s)
+        if self.hunters:
+            self._send_hunters(data)
 
     def handle_indicators_search(self, id, mtype, token, data):
-        self.handle_message_default(id, mtype, token, data)
+        key, itype = (None, None)
+        if self.cache:
+            key, itype = self.cache.key(token, data)
+
+        rv = self.cache.get(key) if key else None
+        if rv is not None:
+            # the reply as the store sent it, chunk by chunk when streamed
+            for chunk in rv:
+                Msg(id=id, mtype=mtype, data=chunk).send(self.frontend_s)
+
+        elif not self.handle_message_default(id, mtype, token, data, cache=(key, itype)):
+            return
+
+        # bulk searches (a list of filters) stay with the store, consumers split lists as gatherer batches and
+        # would hunt and publish every input
+        if data.lstrip().startswith('['):
+            return
 
         # TODO- issue here with un-authorized messages, may need to
         # re-think using store success/fail status
         if self.hunters:
-            self.hunters.socket.send_string(data)
+            self._send_hunters(data)
 
         if self.streamer:
             self.streamer.socket.send_string(data)
@@ -252,8 +436,7 @@ class Router(object):
             self.webhooks.socket.send_string(data)
 
     def handle_indicators_create(self, id, mtype, token, data):
-        Msg(id=id, mtype=mtype, token=token, data=data)\
-            .send(self.gatherers.s)
+        self._send('gatherers', self.gatherers.s, id, mtype, token, data)
 
     def start(self):
         self._init_store(**self.kwargs)
@@ -271,14 +454,11 @@ class Router(object):
 
         logger.debug('starting loop')
 
-        # we use this instead of a loop so we can make sure to get front end
-        # queries as they come in that way hunters don't over burden the store,
-        # think of it like QoS it's weighted so front end has a higher chance
-        # of getting a faster response
+        # one poller over everything, messages are queued per class (search, write, gatherer, hunter) and
+        # handed out by weight so a hunter or gatherer storm can't crowd out interactive searches
         while not self.terminate:
-            self._poll_frontend()
-
-            self._poll_backend()
+            self._poll()
+            self._schedule()
 
             if self.test:
                 break
@@ -10,6 +10,7 @@ import arrow
 import zmq
 import time
 import traceback
+import multiprocessing as mp
 from base64 import b64decode
 from importlib import import_module
 from pprint import pprint
@@ -17,7 +18,8 @@ from types import GeneratorType
 
 from csirtg_indicator import Indicator
 from cifsdk.msg import Msg
-from cif.constants import STORE_ADDR, STORE_WRITE_ADDR, STORE_WRITE_H_ADDR
+from cif.constants import STORE_ADDR, STORE_WRITE_ADDR, STORE_WRITE_H_ADDR, STORE_HANDOFF_ADDR, \
+    STORE_INVALIDATE_ADDR
 from cifsdk.constants import REMOTE_ADDR, CONFIG_PATH
 from cifsdk.exceptions import AuthError, InvalidSearch
 from cifsdk.utils import setup_logging, setup_signals, load_plugin
@@ -42,8 +44,9 @@ if TRACE == '1':
 
 class Manager(_Manager):
 
-    def __init__(self, context):
+    def __init__(self, context, readers=STORE_READERS):
         _Manager.__init__(self, Store, 1)
+        self.readers = int(readers)
 
         self.socket = context.socket(zmq.DEALER)
         self.socket.bind(STORE_ADDR)
@@ -54,21 +57,57 @@ class Manager(_Manager):
         self.s_hunter_write = context.socket(zmq.DEALER)
         self.s_hunter_write.bind(STORE_WRITE_H_ADDR)
 
+    def start(self, **kwargs):
+        if not self.readers:
+            return _Manager.start(self, **kwargs)
+
+        # one writer owns the write sockets, the readers share the read socket (the dealer round-robins them)
+        # the writer is built first so the schema is in place before the readers open it read-only
+        for role, n in [('writer', 1), ('reader', self.readers)]:
+            for _ in range(n):
+                p = mp.Process(target=Store(role=role, **kwargs).start)
+                p.start()
+                self.workers.append(p)
+
+        return self.workers
+
 
 class Store(MyProcess):
     def __init__(self, store_type=STORE_DEFAULT, store_address=STORE_ADDR,
-                 **kwargs):
+                 role='all', **kwargs):
         MyProcess.__init__(self)
 
         self.store_addr = store_address
         self.store = store_type
+        self.role = role
         self.kwargs = kwargs
+
+        # readers can't write, writers share the db with them
+        if role == 'reader':
+            self.kwargs['readonly'] = True
+
+        if role == 'writer':
+            self.kwargs.setdefault('journal_mode', 'WAL')
+
         self.create_queue = {}
         self.create_queue_count = 0
 
+        # search logs, written with the create queue so searches never wait on the write lock
+        self.search_queue = {}
+        self.search_queue_count = 0
+
+        # adaptive flushing, batch size follows the measured per-row commit cost
+        self.create_queue_batch = CREATE_QUEUE_MAX
+        self.row_latency = None
+        self.flush_latency = 0
+
+        self.activity_flushed = time.time()
+
         self.router = None
         self.router_write = None
         self.router_write_h = None
+        self.handoff = None
+        self.invalidations = None
         self.context = None
 
         self._load_plugin(**self.kwargs)
@@ -91,13 +130,15 @@ class Store(MyProcess):
         self.store = p(**kwargs)
 
     def _check_create_queue(self, last_flushed):
-        if len(self.create_queue) == 0:
+        if len(self.create_queue) == 0 and len(self.search_queue) == 0:
             return time.time()
 
         if ((time.time() - last_flushed) <= CREATE_QUEUE_FLUSH) \
-                and (self.create_queue_count < CREATE_QUEUE_MAX):
+                and (self.create_queue_count < self.create_queue_batch) \
+                and (self.search_queue_count < CREATE_QUEUE_MAX):
             return last_flushed
 
+        self._flush_search_queue()
         self._flush_create_queue()
 
         for t in list(self.create_queue):
@@ -114,6 +155,26 @@ class Store(MyProcess):
 
         return time.time()
 
+    def _poll_timeout(self, last_flushed):
+        # block until the next create queue flush is due, nothing to wake up for otherwise
+        if len(self.create_queue) == 0 and len(self.search_queue) == 0:
+            return STORE_POLL_MAX
+
+        due = (last_flushed + CREATE_QUEUE_FLUSH - time.time()) * 1000
+        return max(0, min(int(due), STORE_POLL_MAX))
+
+    def _handle_socket(self, s, n=1):
+        for _ in range(n):
+            m = Msg().recv(s)
+            try:
+                self.handle_message(m, s)
+            except Exception as e:
+                logger.error(e)
+                logger.debug(m)
+
+            if not s.poll(0):
+                return
+
     def _log_search(self, t, data):
         # don't log bulk searches
         if isinstance(data, list) and len(data) > 1:
@@ -144,7 +205,60 @@ class Store(MyProcess):
             group=t['groups'][0],
             count=1,
         )
-        self.store.indicators.create(t, [s.__dict__()])
+
+        self._queue_search(t, s.__dict__())
+
+    def _queue_search(self, t, data):
+        if not self.search_queue.get(t['token']):
+            self.search_queue[t['token']] = {'token': t, 'messages': []}
+
+        self.search_queue[t['token']]['messages'].append(data)
+        self.search_queue_count += 1
+
+    def _flush_search_queue(self):
+        q, self.search_queue = self.search_queue, {}
+        self.search_queue_count = 0
+
+        for token, m in q.items():
+            # readers hand theirs to the writer, one message per token
+            if self.role == 'reader':
+                self._handoff('indicators_create', token, m['messages'])
+                continue
+
+            try:
+                self.store.indicators.create(m['token'], m['messages'])
+            except Exception as e:
+                logger.error(e)
+
+    def _flush_batch(self, _t, data, rejected):
+        s1 = time.time()
+        updated = self.store.indicators.upsert(_t, data, rejected=rejected)
+        self._adapt_batch(time.time() - s1, len(data))
+
+        return updated
+
+    def _adapt_batch(self, latency, n):
+        # ewma of the per-row commit cost, batches are sized so a commit takes about CREATE_QUEUE_TARGET
+        self.flush_latency = latency
+
+        cost = latency / max(n, 1)
+        if self.row_latency is None:
+            self.row_latency = cost
+        else:
+            self.row_latency = (0.8 * self.row_latency) + (0.2 * cost)
+
+        size = int(CREATE_QUEUE_TARGET / self.row_latency) if self.row_latency else CREATE_QUEUE_MAX
+        self.create_queue_batch = max(CREATE_QUEUE_MIN, min(size, CREATE_QUEUE_MAX))
+
+    def metrics(self):
+        return {
+            'create_queue_batch': self.create_queue_batch,
+            'create_queue_flush_latency': round(self.flush_latency, 4),
+            'create_queue_count': self.create_queue_count,
+            'create_queue_depth': {
+                q.get('username') or 'unknown': len(q['messages']) for q in self.create_queue.values()
+            },
+        }
 
     def _flush_create_queue(self):
         for t in self.create_queue:
@@ -152,14 +266,28 @@ class Store(MyProcess):
                 continue
 
             logger.debug('flushing queue...')
-            data = [msg[0] for _, _, msg in self.create_queue[t]['messages']]
-            _t = self.store.tokens.write(t)
+            messages = self.create_queue[t]['messages']
+            data = [d for _, _, _, d in messages]
 
+            rejected = []
             try:
+                _t = self.store.tokens.write(t)
+
                 logger.info('inserting %d indicators..', len(data))
 
-                rv = self.store.indicators.upsert(_t, data)
-                rv = {"status": "success", "data": rv}
+                # upsert counts the existing records it touched, the rest were inserted or rejected
+                updated = 0
+                for i in range(0, len(data), self.create_queue_batch):
+                    updated += self._flush_batch(_t, data[i:i + self.create_queue_batch], rejected)
+
+                rv = {"status": "success", "data": {
+                    'inserted': len(data) - updated - len(rejected),
+                    'updated': updated,
+                    'rejected': len(rejected),
+                }}
+
+                if rejected:
+                    logger.warning('%d queued indicators rejected', len(rejected))
 
             except AuthError as e:
                 rv = {'status': 'failed', 'message': 'unauthorized'}
@@ -168,9 +296,16 @@ class Store(MyProcess):
                 logger.error(e)
                 rv = {'status': 'failed', 'message': 'store failure'}
 
-            for id, client_id, _ in self.create_queue[t]['messages']:
-                Msg(id=id, client_id=client_id, mtype=Msg.INDICATORS_CREATE,
-                    data=rv)
+            # ack every queued message with the batch counts, failed if its own indicator was rejected
+            for id, client_id, s, d in messages:
+                r = rv
+                if any(d is i for i in rejected):
+                    r = {'status': 'failed', 'message': 'rejected', 'data': rv.get('data')}
+
+                if s is None:
+                    continue
+
+                Msg(id=id, client_id=client_id, mtype=Msg.INDICATORS_CREATE, data=json.dumps(r)).send(s)
 
             if rv['status'] == 'success':
                 try:
@@ -180,93 +315,116 @@ class Store(MyProcess):
 
             logger.debug('queue flushed..')
 
+        logger.info('create queue: %s', self.metrics())
+
     def start(self):
         self.context = zmq.Context()
-        self.router = self.context.socket(zmq.ROUTER)
-        self.router_write = self.context.socket(zmq.ROUTER)
-        self.router_write_h = self.context.socket(zmq.ROUTER)
 
-        t = self.token_handler.token_create_admin()
-        if t:
-            self.token_handler.token_create_fm(token=t)
+        reads = []
+        writes = []
 
-        if not os.path.exists(ROUTER_CONFIG_PATH):
-            t = self.token_handler.token_create_hunter()
-            with open(ROUTER_CONFIG_PATH, 'w') as f:
-                f.write('hunter_token: %s' % t)
-
-        self.router.connect(self.store_addr)
-        self.router_write.connect(STORE_WRITE_ADDR)
-        self.router_write_h.connect(STORE_WRITE_H_ADDR)
+        if self.role != 'reader':
+            t = self.token_handler.token_create_admin()
+            if t:
+                self.token_handler.token_create_fm(token=t)
+
+            if not os.path.exists(ROUTER_CONFIG_PATH):
+                t = self.token_handler.token_create_hunter()
+                with open(ROUTER_CONFIG_PATH, 'w') as f:
+                    f.write('hunter_token: %s' % t)
+
+            self.router_write = self.context.socket(zmq.ROUTER)
+            self.router_write_h = self.context.socket(zmq.ROUTER)
+            self.router_write.connect(STORE_WRITE_ADDR)
+            self.router_write_h.connect(STORE_WRITE_H_ADDR)
+            writes = [self.router_write, self.router_write_h]
+
+        if self.role != 'writer':
+            self.router = self.context.socket(zmq.ROUTER)
+            self.router.connect(self.store_addr)
+            reads = [self.router]
+
+        # readers hand their writes (last activity, search logs) to the writer
+        if self.role == 'writer':
+            self.handoff = self.context.socket(zmq.PULL)
+            self.handoff.bind(STORE_HANDOFF_ADDR)
+
+        if self.role == 'reader':
+            self.handoff = self.context.socket(zmq.PUSH)
+            self.handoff.connect(STORE_HANDOFF_ADDR)
+
+        # token edits and deletes land on the writer, the readers' token caches hear about them here
+        if self.role == 'writer':
+            self.invalidations = self.context.socket(zmq.PUB)
+            self.invalidations.bind(STORE_INVALIDATE_ADDR)
+            self.token_handler.notify = self._publish_invalidate
+
+        if self.role == 'reader':
+            self.invalidations = self.context.socket(zmq.SUB)
+            self.invalidations.setsockopt_string(zmq.SUBSCRIBE, '')
+            self.invalidations.connect(STORE_INVALIDATE_ADDR)
+
+        first, rest = reads, writes
+        if STORE_PRIORITY == 'write':
+            first, rest = writes, reads
 
         poller = zmq.Poller()
-        poller.register(self.router, zmq.POLLIN)
+        for s in first + rest:
+            poller.register(s, zmq.POLLIN)
 
-        poller_write = zmq.Poller()
-        poller_write.register(self.router_write, zmq.POLLIN)
+        if self.role == 'writer':
+            poller.register(self.handoff, zmq.POLLIN)
 
-        poller_write_h = zmq.Poller()
-        poller_write_h.register(self.router_write_h, zmq.POLLIN)
+        if self.role == 'reader':
+            poller.register(self.invalidations, zmq.POLLIN)
 
         last_flushed = time.time()
         while not self.exit.is_set():
             try:
-                s = dict(poller.poll(5))
+                s = dict(poller.poll(self._poll_timeout(last_flushed)))
             except KeyboardInterrupt:
                 break
 
-            if self.router in s:
-                m = Msg().recv(self.router)
-                try:
-                    self.handle_message(m)
-                except Exception as e:
-                    logger.error(e)
-                    logger.debug(m)
+            for sock in first:
+                if sock in s:
+                    self._handle_socket(sock, STORE_PRIORITY_BATCH)
 
-            try:
-                s = dict(poller_write.poll(5))
-            except KeyboardInterrupt:
-                break
+            for sock in rest:
+                if sock in s:
+                    self._handle_socket(sock)
 
-            if self.router_write in s:
-                m = Msg().recv(self.router_write)
+            if self.role == 'writer' and self.handoff in s:
+                self._handle_handoff()
 
-                try:
-                    self.handle_message(m)
-                except Exception as e:
-                    logger.error(e)
-                    logger.debug(m)
-
-            try:
-                s = dict(poller_write_h.poll(5))
-            except KeyboardInterrupt:
-                break
-
-            if self.router_write_h in s:
-                m = Msg().recv(self.router_write_h)
-
-                try:
-                    self.handle_message(m)
-                except Exception as e:
-                    logger.error(e)
-                    logger.debug(m)
+            if self.role == 'reader' and self.invalidations in s:
+                self._handle_invalidate()
 
             last_flushed = self._check_create_queue(last_flushed)
+            self._check_activity()
 
-        self.router.close()
-        self.router_write.close()
-        self.router_write_h.close()
+        self._flush_search_queue()
+        self._check_activity(force=True)
 
-    def handle_message(self, m):
+        for sock in reads + writes + [self.handoff, self.invalidations]:
+            if sock:
+                sock.close()
+
+    def handle_message(self, m, s=None):
         err = None
         id, client_id, token, mtype, data = m
 
+        # replies go back out the socket the message came in on
+        if s is None:
+            s = self.router
+            if mtype == 'indicators_create':
+                s = self.router_write
+
         try:
             data = json.loads(data)
         except ValueError as e:
             logger.error(e)
             data = json.dumps({"status": "failed"})
-            Msg(id=id, client_id=client_id, mtype=mtype, data=data).send(self.router)
+            Msg(id=id, client_id=client_id, mtype=mtype, data=data).send(s)
             return
 
         if mtype.startswith('tokens'):
@@ -280,12 +438,12 @@ class Store(MyProcess):
 
         if not handler:
             logger.error('message type {0} unknown'.format(mtype))
-            Msg(id=id, client_id=client_id, mtype=mtype, data='0').send(self.router)
+            Msg(id=id, client_id=client_id, mtype=mtype, data='0').send(s)
             return
 
         rv = False
         try:
-            rv = handler(token, data, id=id, client_id=client_id)
+            rv = handler(token, data, id=id, client_id=client_id, s=s)
 
         except AuthError as e:
             logger.error(e)
@@ -302,46 +460,118 @@ class Store(MyProcess):
             traceback.print_exc()
             err = 'unknown failure'
 
-        if rv == MORE_DATA_NEEDED:
-            rv = {"status": "success", "data": '1'}
+        # streamed searches go out chunk by chunk as the cursor is read
+        if not err and isinstance(rv, GeneratorType):
+            err = self._send_chunks(id, client_id, mtype, rv, s)
+
+        elif not err and rv == MORE_DATA_NEEDED:
+            # queued, acked by _flush_create_queue once its batch commits
+            return
+
         else:
             rv = {"status": "success", "data": rv}
 
-        if err:
-            rv = {'status': 'failed', 'message': err}
+            if err:
+                rv = {'status': 'failed', 'message': err}
+
+            try:
+                data = json.dumps(rv)
+            except Exception as e:
+                logger.error(e)
+                traceback.print_exc()
+                data = json.dumps({'status': 'failed', 'message': 'feed too large, retry the query'})
+
+            Msg(id=id, client_id=client_id, mtype=mtype, data=data).send(s)
 
+        if not err:
+            self._update_last_activity(token)
+
+    def _update_last_activity(self, token):
         try:
-            data = json.dumps(rv)
+            self.store.tokens.update_last_activity_at(token, arrow.utcnow().datetime)
         except Exception as e:
             logger.error(e)
-            traceback.print_exc()
-            data = json.dumps({'status': 'failed', 'message': 'feed too large, retry the query'})
 
-        s = self.router
-        if mtype == 'indicators_create':
-            s = self.router_write
+    def _check_activity(self, force=False):
+        if not force and (time.time() - self.activity_flushed) < ACTIVITY_FLUSH:
+            return
 
-        Msg(id=id, client_id=client_id, mtype=mtype, data=data).send(s)
+        self.activity_flushed = time.time()
 
-        if not err:
-            try:
-                self.store.tokens.update_last_activity_at(token, arrow.utcnow().datetime)
-            except Exception as e:
-                logger.error(e)
+        # readers hand their buffered timestamps to the writer in one message
+        if self.role == 'reader':
+            activity = self.store.tokens.pop_last_activity()
+            if activity:
+                self._handoff('last_activity', None, {t: ts.isoformat() for t, ts in activity.items()})
+            return
+
+        try:
+            n = self.store.tokens.flush_last_activity()
+            if n:
+                logger.debug('flushed last_activity_at for %d tokens', n)
+
+        except Exception as e:
+            logger.error(e)
+
+    def _handoff(self, mtype, token, data=None):
+        self.handoff.send_string(json.dumps({'mtype': mtype, 'token': token, 'data': data}))
+
+    def _handle_handoff(self):
+        m = json.loads(self.handoff.recv_string())
+
+        try:
+            if m['mtype'] == 'last_activity':
+                for t, ts in m['data'].items():
+                    self.store.tokens.update_last_activity_at(t, ts)
+
+            elif m['mtype'] == 'indicators_create':
+                for d in m['data']:
+                    self._queue_search(self.store.tokens.read(m['token']), d)
+
+        except Exception as e:
+            logger.error(e)
+
+    def _publish_invalidate(self, token, username=None):
+        self.invalidations.send_string(json.dumps({'token': token, 'username': username}))
 
-    def _queue_indicator(self, id, token, data, client_id):
+    def _handle_invalidate(self):
+        m = json.loads(self.invalidations.recv_string())
+        self.store.tokens.invalidate(token=m.get('token'), username=m.get('username'))
+
+    def _send_chunks(self, id, client_id, mtype, chunks, s):
+        # one bounded envelope per chunk, the last one is empty with more=false (end of stream)
+        err = None
+        try:
+            for rv in chunks:
+                data = json.dumps({'status': 'success', 'data': rv, 'more': True})
+                Msg(id=id, client_id=client_id, mtype=mtype, data=data).send(s)
+
+            rv = {'status': 'success', 'data': [], 'more': False}
+
+        except Exception as e:
+            logger.error(e)
+            if logger.getEffectiveLevel() == logging.DEBUG:
+                traceback.print_exc()
+
+            err = 'unknown failure'
+            rv = {'status': 'failed', 'message': err, 'more': False}
+
+        Msg(id=id, client_id=client_id, mtype=mtype, data=json.dumps(rv)).send(s)
+        return err
+
+    def _queue_indicator(self, id, token, data, client_id, s=None, username=None):
         if not self.create_queue.get(token):
-            self.create_queue[token] = {'count': 0, "messages": []}
+            self.create_queue[token] = {'count': 0, "messages": [], 'username': username}
 
         self.create_queue[token]['count'] += 1
         self.create_queue_count += 1
         self.create_queue[token]['last_activity'] = time.time()
-        self.create_queue[token]['messages'].append((id, client_id, [data]))
+        self.create_queue[token]['messages'].append((id, client_id, s, data))
 
         return MORE_DATA_NEEDED
 
     def handle_indicators_create(self, token, data, id=None, client_id=None,
-                                 flush=False, force=False):
+                                 flush=False, force=False, s=None):
         # this will raise AuthError if false
         t = self.store.tokens.write(token)
 
@@ -353,7 +583,7 @@ class Store(MyProcess):
             _cleanup_indicator(data)
 
             logger.debug('queuing indicator...')
-            return self._queue_indicator(id, token, data, client_id)
+            return self._queue_indicator(id, token, data, client_id, s=s, username=t.get('username'))
 
         # more than one, send it..
         if isinstance(data, dict):
@@ -364,15 +594,28 @@ class Store(MyProcess):
             _check_indicator(i, t)
             _cleanup_indicator(i)
 
+        rejected = []
         try:
-            return self.store.indicators.create(t, data, flush=flush)
+            rv = self.store.indicators.create(t, data, flush=flush,
+                                              rejected=rejected)
 
         except Exception as e:
             logger.error(e)
+            return
+
+        if rejected:
+            logger.warning('%d of %d indicators rejected', len(rejected),
+                           len(data))
+
+        return rv
 
     def handle_indicators_search(self, token, data, **kwargs):
         t = self.store.tokens.read(token)
 
+        stream = False
+        if isinstance(data, dict):
+            stream = data.pop('stream', False) in ['1', 'True', 1, True]
+
         try:
             self._log_search(t, data)
 
@@ -383,6 +626,9 @@ class Store(MyProcess):
             logger.error(e)
 
         try:
+            if stream:
+                return self.store.indicators.search_chunks(t, data, size=STREAM_CHUNK)
+
             x = self.store.indicators.search(t, data)
 
         except TypeError as e:
@@ -432,6 +678,8 @@ def main():
 
         example usage:
             $ cif-store -d
+            $ cif-store --explain
+            $ cif-store --fts-drop
         '''),
         formatter_class=RawDescriptionHelpFormatter,
         prog='cif-store',
@@ -460,6 +708,11 @@ def main():
 
     p.add_argument('--remote', help='specify remote')
 
+    p.add_argument('--explain', help='show the query plans for the standard feed and search queries, '
+                                     'flagging full scans and sorts', action="store_true")
+    p.add_argument('--fts-drop', help='drop the full text search index (CIF_STORE_SQLITE_FTS=1 rebuilds it)',
+                   action="store_true")
+
     args = p.parse_args()
 
     groups = args.token_groups.split(',')
@@ -470,10 +723,37 @@ def main():
 
     if not args.token_create_fm and not args.token_create_admin and \
             not args.token_create_hunter and not \
-            args.token_create_httpd:
+            args.token_create_httpd and not args.explain and not args.fts_drop:
         logger.error('missing required arguments, see -h for more information')
         raise SystemExit
 
+    if args.explain:
+        with Store(store_type=args.store) as s:
+            if not hasattr(s.store.indicators, 'explain'):
+                logger.error('{} store does not support --explain'.format(args.store))
+                raise SystemExit(1)
+
+            flagged = 0
+            for name, plan, flags in s.store.indicators.explain(groups=groups[0]):
+                print('{}: {}'.format(name, ' | '.join(plan)))
+                for f in flags:
+                    print('  !! {}'.format(f))
+
+                flagged += len(flags)
+
+        raise SystemExit(1 if flagged else 0)
+
+    if args.fts_drop:
+        with Store(store_type=args.store) as s:
+            if not hasattr(s.store.indicators, 'drop_fts'):
+                logger.error('{} store does not support --fts-drop'.format(args.store))
+                raise SystemExit(1)
+
+            if s.store.indicators.drop_fts():
+                logger.info('full text search index dropped')
+
+        raise SystemExit
+
     if args.token_create_fm:
         with Store(store_type=args.store) as s:
             s._load_plugin(store_type=args.store)
@@ -14,16 +14,41 @@ STORE_DEFAULT = os.environ.get('CIF_STORE_STORE', 'sqlite')
 STORE_PLUGINS = ['cif.store.sqlite', 'cif.store.elasticsearch']
 
 # seconds to flush the queue [interval]
-CREATE_QUEUE_FLUSH = os.environ.get('CIF_STORE_QUEUE_FLUSH', 5)
+CREATE_QUEUE_FLUSH = float(os.environ.get('CIF_STORE_QUEUE_FLUSH', 5))
 
 # num of records before we start throttling a token
-CREATE_QUEUE_LIMIT = os.environ.get('CIF_STORE_QUEUE_LIMIT', 250)
+CREATE_QUEUE_LIMIT = int(os.environ.get('CIF_STORE_QUEUE_LIMIT', 250))
 
 # seconds of in-activity before we remove from the penalty box
-CREATE_QUEUE_TIMEOUT = os.environ.get('CIF_STORE_TIMEOUT', 5)
+CREATE_QUEUE_TIMEOUT = float(os.environ.get('CIF_STORE_TIMEOUT', 5))
+
+# queue max to flush before we hit CIF_STORE_QUEUE_FLUSH mark, the adaptive batch size never goes above it
+CREATE_QUEUE_MAX = int(os.environ.get('CIF_STORE_QUEUE_MAX', 1000))
+
+# smallest batch the adaptive flusher will shrink to
+CREATE_QUEUE_MIN = int(os.environ.get('CIF_STORE_QUEUE_MIN', 25))
+
+# seconds a single batch commit should take, the flusher sizes batches to hit it
+CREATE_QUEUE_TARGET = float(os.environ.get('CIF_STORE_QUEUE_TARGET', 0.25))
+
+# reader processes next to a single writer, 0 runs one store process for everything
+STORE_READERS = int(os.environ.get('CIF_STORE_READERS', 0))
+
+# which sockets the store drains first when several are ready, read (searches) or write
+STORE_PRIORITY = os.environ.get('CIF_STORE_PRIORITY', 'read')
+
+# messages taken off the priority sockets per loop before the others get one
+STORE_PRIORITY_BATCH = int(os.environ.get('CIF_STORE_PRIORITY_BATCH', 10))
+
+# ms the store blocks in poll when nothing is queued, bounds how long shutdown takes to notice
+STORE_POLL_MAX = int(os.environ.get('CIF_STORE_POLL_MAX', 1000))
+
+# rows per envelope when a search is streamed back to the router
+STREAM_CHUNK = int(os.environ.get('CIF_STORE_STREAM_CHUNK', 500))
+
+# seconds token last_activity_at timestamps are buffered before they're written in one batch
+ACTIVITY_FLUSH = float(os.environ.get('CIF_STORE_ACTIVITY_FLUSH', 30))
 
-# queue max to flush before we hit CIF_STORE_QUEUE_FLUSH mark
-CREATE_QUEUE_MAX = os.environ.get('CIF_STORE_QUEUE_MAX', 1000)
 REQUIRED_ATTRIBUTES = ['group', 'provider', 'indicator', 'itype', 'tags']
 TRACE = os.environ.get('CIF_STORE_TRACE')
 GROUPS = ['everyone']
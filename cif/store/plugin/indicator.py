@@ -14,6 +14,11 @@ class IndicatorManagerPlugin(object):
     def create(self, token, indicators, **kwargs):
         raise NotImplementedError
 
+    def search_chunks(self, token, filters, size=500, **kwargs):
+        # stores that can't page their cursor still stream, from the materialized result
+        rv = self.search(token, filters, **kwargs)
+        return (rv[i:i + size] for i in range(0, len(rv), size))
+
     def _check_token_groups(self, t, i):
         if not i.get('group'):
             raise ValueError('missing group')
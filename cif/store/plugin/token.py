@@ -1,17 +1,24 @@
 import arrow
-from cif.constants import TOKEN_CACHE_DELAY, TOKEN_LENGTH
+from cif.constants import TOKEN_CACHE_TTL, TOKEN_CACHE_SIZE, TOKEN_CACHE_NEGATIVE_TTL, TOKEN_LENGTH
 from cifsdk.exceptions import AuthError
 import os
 import binascii
 import abc
+import time
+from collections import OrderedDict
 
 
 class TokenManagerPlugin(object):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, *args, **kwargs):
-        self._cache = {}
-        self._cache_check_next = arrow.utcnow().timestamp + TOKEN_CACHE_DELAY
+        # token -> (expires, record), record is None for tokens we know don't exist
+        self._cache = OrderedDict()
+        self._cache_size = kwargs.get('cache_size', TOKEN_CACHE_SIZE)
+        self._cache_ttl = kwargs.get('cache_ttl', TOKEN_CACHE_TTL)
+
+        # token -> last seen, written out by flush_last_activity()
+        self._activity = {}
 
     @abc.abstractmethod
     def create(self, data):
@@ -30,45 +37,91 @@ class TokenManagerPlugin(object):
         raise NotImplementedError
 
     @abc.abstractmethod
-    def update_last_activity_at(self, timestamp):
+    def update_last_activity_at(self, token, timestamp=None):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def flush_last_activity(self):
+        raise NotImplementedError
+
+    def pop_last_activity(self):
+        rv, self._activity = self._activity, {}
+        return rv
+
     def _generate(self):
         return binascii.b2a_hex(os.urandom(TOKEN_LENGTH)).decode('utf-8')
 
-    def _flush_cache(self):
-        if arrow.utcnow().timestamp > self._cache_check_next:
-            self._cache = {}
-            self._cache_check_next = arrow.utcnow().timestamp + TOKEN_CACHE_DELAY
+    def _cache_get(self, token):
+        e = self._cache.get(token)
+        if e is None:
+            return False, None
+
+        if e[0] < time.time():
+            del self._cache[token]
+            return False, None
+
+        self._cache.move_to_end(token)
+        return True, e[1]
+
+    def _cache_set(self, token, rv, ttl=None):
+        if ttl is None:
+            ttl = self._cache_ttl if rv is not None else TOKEN_CACHE_NEGATIVE_TTL
+
+        now = time.time()
+        expires = now + ttl
+
+        # never cache a token past its own expiry
+        if rv is not None and rv.get('expires'):
+            expires = min(expires, arrow.get(rv['expires']).timestamp)
+
+        self._cache[token] = (expires, rv)
+        self._cache.move_to_end(token)
+
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+        return rv
 
     def _cache_check(self, token, k=None):
-        self._flush_cache()
-        if token not in self._cache:
+        _, rv = self._cache_get(token)
+        if not rv:
             return False
 
-        return self._cache[token]
+        return rv
+
+    def invalidate(self, token=None, username=None):
+        if token is None and username is None:
+            self._cache.clear()
+            return
 
+        for t, (_, rv) in list(self._cache.items()):
+            if t == token or (username and rv and rv.get('username') == username):
+                del self._cache[t]
+
+    # the token when it's stored in plaintext, True when only its hash is
     def admin_exists(self):
         t = list(self.search({'admin': True}))
         if len(t) > 0:
-            return t[0]['token']
+            return t[0]['token'] or True
 
     def fm_exists(self):
         t = list(self.search({'username': 'csirtg-fm'}))
         if len(t) > 0:
-            return t[0]['token']
+            return t[0]['token'] or True
 
     def check(self, token, k, v=True):
-        self._flush_cache()
-        if token in self._cache and self._cache[token].get(k):
-            return self._cache[token]
-
-        rv = list(self.search({'token': token, k: v}))
-        if len(rv) == 0:
+        hit, rv = self._cache_get(token)
+        if not hit:
+            rv = next(iter(self.search({'token': token})), None)
+            if rv is None:
+                self._cache_set(token, None)
+            else:
+                self.update_last_activity_at(token)
+
+        if rv is None or bool(rv.get(k)) != v:
             raise AuthError('unauthorized')
 
-        self.update_last_activity_at(token)
-        return rv[0]
+        return rv
 
     def admin(self, token):
         return self.check(token, 'admin')
@@ -80,8 +133,9 @@ class TokenManagerPlugin(object):
         return self.check(token, 'write')
 
     def last_activity_at(self, token):
-        if token in self._cache and self._cache[token].get('last_activity_at'):
-            return self._cache[token].get('last_activity_at')
+        rv = self._cache_check(token)
+        if rv and rv.get('last_activity_at'):
+            return rv['last_activity_at']
 
         rv = list(self.search({'token': token}))
 
@@ -1,5 +1,6 @@
 import logging
 import os
+import sqlite3
 
 from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
@@ -11,8 +12,8 @@ from cif.store.plugin import Store
 from cifsdk.constants import PYVERSION
 
 Base = declarative_base()
-from .token import TokenManager, Token
-from .indicator import Indicator, IndicatorManager
+from .token import TokenManager, Token, TOKEN_HASH_ONLY
+from .indicator import Indicator, IndicatorManager, UPSERT_MODE, FTS
 
 DB_PATH = os.path.join(DATA_PATH, 'cifv4.db')
 
@@ -25,6 +26,9 @@ SYNC = os.environ.get('CIF_STORE_SQLITE_SYNC', 'NORMAL')
 # https://www.sqlite.org/pragma.html#pragma_cache_size
 CACHE_SIZE = os.environ.get('CIF_STORE_SQLITE_CACHE_SIZE', 512000000)  # 512MB
 
+# WAL lets store readers run next to the writer, the store writer switches to it
+JOURNAL_MODE = os.environ.get('CIF_STORE_SQLITE_JOURNAL_MODE', 'MEMORY')
+
 AUTOFLUSH = os.getenv('CIF_STORE_SQLITE_AUTOFLUSH', '1')
 if AUTOFLUSH == '0':
     AUTOFLUSH = False
@@ -41,11 +45,14 @@ if TRACE == '0':
     logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
 
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
+def set_sqlite_pragma(dbapi_connection, connection_record, journal_mode=JOURNAL_MODE):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.execute("PRAGMA journal_mode = MEMORY")
+
+    # the journal mode belongs to the writer, read-only connections can't change it
+    if journal_mode:
+        cursor.execute("PRAGMA journal_mode = {}".format(journal_mode))
+
     cursor.execute("PRAGMA synchronous = {}".format(SYNC))
     cursor.execute("PRAGMA temp_store = MEMORY")
     cursor.execute("PRAGMA cache_size = {}".format(CACHE_SIZE))
@@ -56,28 +63,43 @@ class SQLite(Store):
     # http://www.pythoncentral.io/sqlalchemy-orm-examples/
     name = 'sqlite'
 
-    def __init__(self, autocommit=False, autoflush=AUTOFLUSH, dictrows=True, **kwargs):
+    def __init__(self, autocommit=False, autoflush=AUTOFLUSH, dictrows=True, readonly=False,
+                 journal_mode=JOURNAL_MODE, **kwargs):
         self.autocommit = autocommit
         self.autoflush = autoflush
         self.dictrows = dictrows
+        self.readonly = readonly
 
-        self.path = kwargs.get('db_path', kwargs.get('nodes'))
-        if not self.path:
-            self.path = DB_PATH
+        db = kwargs.get('db_path', kwargs.get('nodes'))
+        if not db:
+            db = DB_PATH
 
-        self.path = "sqlite:///{0}".format(self.path)
+        self.path = "sqlite:///{0}".format(db)
 
         # http://docs.sqlalchemy.org/en/latest/orm/contextual.html
-        self.engine = create_engine(self.path, echo=False)
+        if readonly:
+            # store readers, the writer owns the schema and the journal mode
+            journal_mode = None
+            self.engine = create_engine('sqlite://', echo=False, creator=lambda: sqlite3.connect(
+                'file:{}?mode=ro'.format(db), uri=True))
+        else:
+            self.engine = create_engine(self.path, echo=False)
+
+        event.listen(self.engine, 'connect', lambda c, r: set_sqlite_pragma(c, r, journal_mode=journal_mode))
+
         self.handle = sessionmaker(bind=self.engine, autocommit=self.autocommit, autoflush=self.autoflush)
         self.handle = scoped_session(self.handle)
 
-        Base.metadata.create_all(self.engine)
+        if not readonly:
+            Base.metadata.create_all(self.engine)
 
         logger.debug('database path: {}'.format(self.path))
 
-        self.tokens = TokenManager(self.handle, self.engine)
-        self.indicators = IndicatorManager(self.handle, self.engine)
+        self.tokens = TokenManager(self.handle, self.engine, readonly=readonly,
+                                   hash_only=kwargs.get('hash_only', TOKEN_HASH_ONLY))
+        self.indicators = IndicatorManager(self.handle, self.engine,
+                                           upsert_mode=kwargs.get('upsert_mode', UPSERT_MODE),
+                                           fts=kwargs.get('fts', FTS), readonly=readonly)
 
     def ping(self, t):
         if self.tokens.read(t):
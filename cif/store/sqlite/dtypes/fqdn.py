@@ -17,3 +17,11 @@ class FQDNType(sa.types.TypeDecorator):
     @property
     def python_type(self):
         return self.impl.type.python_type
+
+
+def reverse_labels(value):
+    # www.example.com -> com.example.www, suffix matches become indexable prefix ranges
+    if value is None:
+        return value
+
+    return '.'.join(reversed(value.lower().split('.')))
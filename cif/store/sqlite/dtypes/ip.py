@@ -1,7 +1,11 @@
 from sqlalchemy.ext.declarative import declarative_base
 from . import IOCType
+import ipaddress
 import socket
 
+# sqlite integers are signed 64bit, shift unsigned halves down so they still sort correctly
+INT64_OFFSET = 2 ** 63
+
 Base = declarative_base()
 
 
@@ -36,3 +40,30 @@ class Ip(IOCType):
             return socket.inet_ntop(value)
 
         return process
+
+
+def split128(n):
+    return (n >> 64) - INT64_OFFSET, (n & (2 ** 64 - 1)) - INT64_OFFSET
+
+
+def ip_range(value):
+    # first / last address of an address or prefix as ints, ipv6 split into (hi, lo) pairs
+    if isinstance(value, bytes):
+        value = ipaddress.ip_address(value)
+
+    net = ipaddress.ip_network(value, strict=False)
+    start, end = int(net.network_address), int(net.broadcast_address)
+
+    if net.version == 6:
+        return split128(start), split128(end)
+
+    return start, end
+
+
+def ip_range_columns(value):
+    start, end = ip_range(value)
+
+    if isinstance(start, tuple):
+        return {'ip_start_hi': start[0], 'ip_start_lo': start[1], 'ip_end_hi': end[0], 'ip_end_lo': end[1]}
+
+    return {'ip_start': start, 'ip_end': end}
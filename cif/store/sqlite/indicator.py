@@ -6,9 +6,12 @@ import ipaddress
 import re
 import logging
 import time
+from itertools import islice
 
 from sqlalchemy import Column, Integer, String, Float, DateTime, UnicodeText, \
-    desc, ForeignKey, or_, Index, func, and_
+    desc, ForeignKey, or_, Index, func, and_, type_coerce, select, text, column, Table, MetaData
+from sqlalchemy.sql.expression import UnaryExpression
+from sqlalchemy.sql.operators import custom_op
 from sqlalchemy.orm import relationship, backref, class_mapper, lazyload
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy_utils.types.url import URLType
@@ -19,9 +22,11 @@ from cifsdk.exceptions import InvalidSearch
 from cifsdk.constants import VALID_FILTERS, PYVERSION, RUNTIME_PATH
 from cif.store.plugin.indicator import IndicatorManagerPlugin
 
-from cif.store.sqlite.dtypes.ip import Ip
-from cif.store.sqlite.dtypes.fqdn import FQDNType
+from cif.store.sqlite.dtypes.ip import Ip, ip_range, ip_range_columns, split128
+from cif.store.sqlite.dtypes.fqdn import FQDNType, reverse_labels
 from cif.store.sqlite.dtypes.hash import HASHType
+from cif.store.sqlite.migrations import NATURAL_KEY, create_natural_key_index, create_index, \
+    add_reversed_labels, add_ip_ranges, add_hashes, add_emails, create_fts, drop_fts, FTS_TABLE
 
 if PYVERSION > 2:
     basestring = (str, bytes)
@@ -29,6 +34,19 @@ if PYVERSION > 2:
 REQUIRED_FIELDS = ['provider', 'indicator', 'tags', 'group', 'itype']
 HASH_TYPES = ['sha1', 'sha256', 'sha512', 'md5']
 
+# max number of bound indicators per pre-fetch query, keeps us under
+# SQLITE_MAX_VARIABLE_NUMBER (999 on older builds)
+PREFETCH_CHUNK = 500
+
+# orm: dedupe in python (provider, itype, indicator, rdata, first tag)
+# native: INSERT .. ON CONFLICT against a unique (provider, itype, indicator, rdata) index, tags are merged
+# the unique index sticks around once created, don't flip back to orm on the same db
+UPSERT_MODE = os.getenv('CIF_STORE_SQLITE_UPSERT_MODE', 'orm')
+
+# build the fts5 index for message, description and asn_desc searches at startup. searches use it whenever it
+# exists (whoever built it), it's only dropped by 'cif-store --fts-drop'
+FTS = os.getenv('CIF_STORE_SQLITE_FTS', '0') == '1'
+
 Base = declarative_base()
 
 logger = logging.getLogger('cif.store.sqlite')
@@ -69,11 +87,18 @@ class Indicator(Base):
     reference = Column(UnicodeText)
     reference_tlp = Column(String)
 
+    # feed pulls: group (+ itype) equality, then reported_at in index order for ORDER BY reported_at DESC,
+    # confidence rides along so rejected rows are skipped without touching the table
+    __table_args__ = (
+        Index('ix_indicators_feed', 'group', 'itype', 'reported_at', 'confidence'),
+        Index('ix_indicators_group_reported_at', 'group', 'reported_at'),
+    )
+
     tags = relationship(
         'Tag',
         primaryjoin='and_(Indicator.id==Tag.indicator_id)',
         backref=backref('tags', uselist=True),
-        lazy='subquery',
+        lazy='select',
         cascade="all,delete"
     )
 
@@ -81,7 +106,7 @@ class Indicator(Base):
         'Message',
         primaryjoin='and_(Indicator.id==Message.indicator_id)',
         backref=backref('messages', uselist=True),
-        lazy='subquery',
+        lazy='select',
         cascade="all,delete"
     )
 
@@ -142,11 +167,17 @@ class Ipv4(Base):
     ipv4 = Column(Ip, index=True)
     mask = Column(Integer, default=32)
 
+    # first / last address of the prefix
+    ip_start = Column(Integer)
+    ip_end = Column(Integer)
+
     indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
     indicator = relationship(
         Indicator,
     )
 
+    __table_args__ = (Index('ix_indicators_ipv4_range', 'ip_start', 'ip_end'),)
+
 
 class Ipv6(Base):
     __tablename__ = 'indicators_ipv6'
@@ -155,17 +186,26 @@ class Ipv6(Base):
     ip = Column(Ip(version=6), index=True)
     mask = Column(Integer, default=64)
 
+    # first / last address of the prefix, 128bit split into signed (hi, lo)
+    ip_start_hi = Column(Integer)
+    ip_start_lo = Column(Integer)
+    ip_end_hi = Column(Integer)
+    ip_end_lo = Column(Integer)
+
     indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
     indicator = relationship(
         Indicator,
     )
 
+    __table_args__ = (Index('ix_indicators_ipv6_range', 'ip_start_hi', 'ip_start_lo', 'ip_end_hi', 'ip_end_lo'),)
+
 
 class Fqdn(Base):
     __tablename__ = 'indicators_fqdn'
 
     id = Column(Integer, primary_key=True)
     fqdn = Column(FQDNType, index=True)
+    fqdn_rev = Column(UnicodeText, index=True)
 
     indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
     indicator = relationship(
@@ -178,8 +218,9 @@ class Email(Base):
 
     id = Column(Integer, primary_key=True)
     email = Column(EmailType, index=True)
+    email_rev = Column(UnicodeText, index=True)
 
-    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
+    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'), index=True)
     indicator = relationship(
         Indicator,
     )
@@ -203,7 +244,7 @@ class Hash(Base):
     id = Column(Integer, primary_key=True)
     hash = Column(HASHType, index=True)
 
-    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
+    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'), index=True)
     indicator = relationship(
         Indicator,
     )
@@ -215,7 +256,7 @@ class Tag(Base):
     id = Column(Integer, primary_key=True)
     tag = Column(String, index=True)
 
-    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
+    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'), index=True)
     indicator = relationship(
         Indicator,
     )
@@ -229,19 +270,182 @@ class Message(Base):
     id = Column(Integer, primary_key=True)
     message = Column(UnicodeText)
 
-    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'))
+    indicator_id = Column(Integer, ForeignKey('indicators.id', ondelete='CASCADE'), index=True)
     indicator = relationship(
         Indicator,
     )
 
 
+# itype -> child table an existing record must have to be considered a match
+ITYPE_TABLES = {
+    'ipv4': Ipv4,
+    'ipv6': Ipv6,
+    'fqdn': Fqdn,
+    'email': Email,
+    'url': Url,
+}
+for h in HASH_TYPES:
+    ITYPE_TABLES[h] = Hash
+
+INDICATOR_COLUMNS = [c.name for c in Indicator.__table__.c if c.name != 'id']
+
+
+def _format_timestamp(v):
+    if not isinstance(v, basestring):
+        return v.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    # sqlite DateTime storage format: YYYY-MM-DD HH:MM:SS[.ffffff]
+    if len(v) == 19:
+        v += '.000000'
+
+    return '{}T{}Z'.format(v[:10], v[11:])
+
+
+def compile_serializer(table, extra=[]):
+    # work out the projection once per table instead of walking the mapper for every row
+    names = [c.name for c in table.c] + [c.name for c in extra]
+    timestamps = [c.name for c in table.c if c.name.endswith('time') or c.name.endswith('_at')]
+
+    # timestamps come back as the raw stored strings, no datetime round trip
+    columns = []
+    for c in table.c:
+        if isinstance(c.type, DateTime):
+            c = type_coerce(c, UnicodeText).label(c.name)
+
+        columns.append(c)
+
+    columns += extra
+
+    def serialize(rows):
+        rv = [{k: v for k, v in zip(names, r) if v is not None and v != 'None' and v != ''} for r in rows]
+
+        for k in timestamps:
+            for d in rv:
+                if k in d:
+                    d[k] = _format_timestamp(d[k])
+
+        return rv
+
+    return columns, serialize
+
+
+# one aggregated tag list per row, rides along with the search query (ix_tags_indicator_id)
+_tags = Tag.__table__.alias('t')
+TAGS_COLUMN = select([func.group_concat(_tags.c.tag)]).where(_tags.c.indicator_id == Indicator.id)\
+    .correlate(Indicator).as_scalar().label('tags')
+
+INDICATOR_SEARCH_COLUMNS, serialize_indicators = compile_serializer(Indicator.__table__, extra=[TAGS_COLUMN])
+
+NATIVE_UPSERT_SQL = """
+    INSERT INTO indicators ({}) VALUES ({})
+    ON CONFLICT ({}) DO UPDATE SET
+        count = ifnull(indicators.count, 1) + 1,
+        last_at = excluded.last_at,
+        reported_at = excluded.reported_at
+    WHERE indicators.last_at IS NULL OR excluded.last_at > indicators.last_at
+""".format(
+    ', '.join('"{}"'.format(c) for c in INDICATOR_COLUMNS),
+    ', '.join('?' * len(INDICATOR_COLUMNS)),
+    ', '.join(NATURAL_KEY)
+)
+
+# bulk search keys, one row per index range to probe (lo <= column <= hi), n is the per key limit
+# ipv4 rows also carry the prefix end (e) and whether they look for containing prefixes (c)
+BULK_KEYS = Table('bulk_keys', MetaData(), Column('k', UnicodeText), Column('lo'), Column('hi'),
+                  Column('e', Integer), Column('c', Integer), Column('n', Integer))
+
+BULK_KEYS_SQL = 'CREATE TEMP TABLE IF NOT EXISTS bulk_keys (k, lo, hi, e, c, n)'
+
+BULK_COLUMNS = {
+    'ipv4': (Ipv4, Ipv4.ip_start),
+    'fqdn': (Fqdn, Fqdn.fqdn_rev),
+    'email': (Email, Email.email_rev),
+    'url': (Url, type_coerce(Url.url, UnicodeText)),
+}
+for h in HASH_TYPES:
+    BULK_COLUMNS[h] = (Hash, type_coerce(Hash.hash, UnicodeText))
+
+# the query shapes feeds and searches send (cif/httpd/indicators.py), feeds should come back in reported_at order
+EXPLAIN_SHAPES = [
+    ('feed', {'itype': 'ipv4', 'confidence': 3, 'reported_at': '2020-01-01T00:00:00Z'}, True),
+    ('feed tags', {'tags': 'phishing', 'confidence': 3, 'reported_at': '2020-01-01T00:00:00Z'}, True),
+    ('feed whitelist', {'itype': 'ipv4', 'tags': 'whitelist', 'confidence': 4,
+                        'reported_at': '2020-01-01T00:00:00Z'}, True),
+    ('search ipv4', {'indicator': '192.0.2.1'}, False),
+    ('search ipv4 cidr', {'indicator': '192.0.2.0/24'}, False),
+    ('search ipv6', {'indicator': '2001:db8::1'}, False),
+    ('search fqdn', {'indicator': 'example.com'}, False),
+    ('search email', {'indicator': 'user@example.com'}, False),
+    ('search url', {'indicator': 'http://example.com/index.html'}, False),
+    ('search hash', {'indicator': 'd41d8cd98f00b204e9800998ecf8427e'}, False),
+]
+
+
 class IndicatorManager(IndicatorManagerPlugin):
 
-    def __init__(self, handle, engine, **kwargs):
+    def __init__(self, handle, engine, upsert_mode=UPSERT_MODE, fts=FTS, readonly=False, **kwargs):
         super(IndicatorManager, self).__init__(**kwargs)
 
         self.handle = handle
-        Base.metadata.create_all(engine)
+        self.engine = engine
+        self.upsert_mode = upsert_mode
+        self.fts_create = fts
+
+        if not readonly:
+            Base.metadata.create_all(engine)
+            self._migrate(engine)
+
+        # bind processors for the raw (non-orm) write path
+        self._processors = {}
+        for t in [Indicator, Ipv4, Ipv6, Fqdn, Email, Url, Hash]:
+            self._processors[t.__tablename__] = {
+                c.name: c.type.dialect_impl(engine.dialect).bind_processor(engine.dialect) for c in t.__table__.c
+            }
+
+    def _migrate(self, engine):
+        conn = engine.raw_connection()
+        try:
+            create_index(conn, 'ix_tags_indicator_id', 'tags', ['indicator_id'])
+            create_index(conn, 'ix_messages_indicator_id', 'messages', ['indicator_id'])
+
+            for ix in Indicator.__table_args__:
+                create_index(conn, ix.name, 'indicators', ['"{}"'.format(c.name) for c in ix.columns])
+
+            add_reversed_labels(conn, 'indicators_fqdn', 'fqdn', reverse_labels)
+            add_reversed_labels(conn, 'indicators_email', 'email', reverse_labels)
+
+            add_ip_ranges(conn, 'indicators_ipv4', 'ipv4', ['ip_start', 'ip_end'], ip_range_columns)
+            add_ip_ranges(conn, 'indicators_ipv6', 'ip', ['ip_start_hi', 'ip_start_lo', 'ip_end_hi', 'ip_end_lo'],
+                          ip_range_columns)
+
+            add_hashes(conn, 'indicators_hash', HASH_TYPES)
+            add_emails(conn, 'indicators_email', reverse_labels)
+
+            if self.upsert_mode == 'native' and create_natural_key_index(conn):
+                logger.info('created natural key index')
+
+            if self.fts_create:
+                create_fts(conn)
+
+            conn.commit()
+        finally:
+            conn.close()
+
+    @property
+    def fts(self):
+        # decided per query, another process may have built (or dropped) the index since we started
+        q = text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name")
+        return self.handle().execute(q, {'name': FTS_TABLE}).first() is not None
+
+    def drop_fts(self):
+        conn = self.engine.raw_connection()
+        try:
+            rv = drop_fts(conn)
+            conn.commit()
+        finally:
+            conn.close()
+
+        return rv
 
     def to_dict(self, obj):
         d = {}
@@ -275,7 +479,7 @@ class IndicatorManager(IndicatorManagerPlugin):
                 raise ValueError("Missing required field: {} for \n{}".format(f, i))
 
     def create(self, token, data, **kwargs):
-        return self.upsert(token, data)
+        return self.upsert(token, data, **kwargs)
 
     def _filter_indicator(self, filters, s):
 
@@ -292,13 +496,17 @@ class IndicatorManager(IndicatorManagerPlugin):
             itype = resolve_itype(i)
         except TypeError as e:
             logger.error(e)
+            if len(i) >= 3 and self.fts:
+                return s.filter(self._fts_match('{message description}', i))
+
             s = s.join(Message).filter(Message.message.like('%{}%'.format(i)))
             return s
 
         if itype == 'email':
+            rev = reverse_labels(i)
             s = s.join(Email).filter(or_(
-                    Email.email.like('%.{}'.format(i)),
-                    Email.email == i)
+                    Email.email_rev == rev,
+                    and_(Email.email_rev > rev + '.', Email.email_rev < rev + '/'))
             )
             return s
 
@@ -309,13 +517,17 @@ class IndicatorManager(IndicatorManagerPlugin):
             if mask < 8:
                 raise InvalidSearch('prefix needs to be >= 8')
 
-            start = str(ip.network_address)
-            end = str(ip.broadcast_address)
+            start, end = ip_range(ip)
 
             logger.debug('{} - {}'.format(start, end))
 
-            s = s.join(Ipv4).filter(Ipv4.ipv4 >= start)
-            s = s.filter(Ipv4.ipv4 <= end)
+            # stored prefixes containing the search have one of these starts, one index probe per mask
+            starts = set(int(ip.supernet(new_prefix=m).network_address) for m in range(0, mask + 1))
+
+            s = s.join(Ipv4).filter(or_(
+                and_(Ipv4.ip_start >= start, Ipv4.ip_start <= end, Ipv4.ip_end <= end),
+                and_(Ipv4.ip_start.in_(starts), Ipv4.ip_end >= end)
+            ))
 
             return s
 
@@ -326,19 +538,32 @@ class IndicatorManager(IndicatorManagerPlugin):
             if mask < 32:
                 raise InvalidSearch('prefix needs to be >= 32')
 
-            start = str(ip.network_address)
-            end = str(ip.broadcast_address)
+            start, end = ip_range(ip)
 
             logger.debug('{} - {}'.format(start, end))
 
-            s = s.join(Ipv6).filter(Ipv6.ip >= start)
-            s = s.filter(Ipv6.ip <= end)
+            inside = and_(
+                Ipv6.ip_start_hi >= start[0], Ipv6.ip_start_hi <= end[0],
+                self._gte128(Ipv6.ip_start_hi, Ipv6.ip_start_lo, start),
+                self._gte128(Ipv6.ip_end_hi, Ipv6.ip_end_lo, end, lte=True)
+            )
+
+            # flat OR so sqlite can probe the range index once per term
+            starts = set(split128(int(ip.supernet(new_prefix=m).network_address)) for m in range(0, mask + 1))
+            containing = [
+                and_(Ipv6.ip_start_hi == hi, Ipv6.ip_start_lo == lo,
+                     self._gte128(Ipv6.ip_end_hi, Ipv6.ip_end_lo, end)) for hi, lo in starts
+            ]
+
+            s = s.join(Ipv6).filter(or_(inside, *containing))
             return s
 
         if itype == 'fqdn':
+            # this domain and all of its subdomains, '/' sorts right after '.'
+            rev = reverse_labels(i)
             s = s.join(Fqdn).filter(or_(
-                    Fqdn.fqdn.like('%.{}'.format(i)),
-                    Fqdn.fqdn == i)
+                    Fqdn.fqdn_rev == rev,
+                    and_(Fqdn.fqdn_rev > rev + '.', Fqdn.fqdn_rev < rev + '/'))
             )
             return s
 
@@ -352,6 +577,20 @@ class IndicatorManager(IndicatorManagerPlugin):
 
         raise ValueError
 
+    def _fts_match(self, columns, v):
+        # the whole term as one fts5 string, the trigram tokenizer makes this a substring match (3+ chars)
+        q = '{} : "{}"'.format(columns, str(v).replace('"', '""'))
+        ids = text('SELECT rowid FROM indicators_fts WHERE indicators_fts MATCH :fts')
+
+        return Indicator.id.in_(ids.bindparams(fts=q).columns(column('rowid', Integer)))
+
+    def _gte128(self, hi_col, lo_col, v, lte=False):
+        # (hi, lo) >= v, or <= v
+        if lte:
+            return or_(hi_col < v[0], and_(hi_col == v[0], lo_col <= v[1]))
+
+        return or_(hi_col > v[0], and_(hi_col == v[0], lo_col >= v[1]))
+
     def _filter_terms(self, filters, s):
 
         idx = ['reported_at', 'itype', 'confidence', 'probability', 'provider', 'asn', 'cc', 'asn_desc',
@@ -408,7 +647,10 @@ class IndicatorManager(IndicatorManagerPlugin):
                 s = s.filter(Indicator.asn == v)
 
             elif k == 'asn_desc':
-                s = s.filter(Indicator.asn_desc.like('%{}%'.format(v)))
+                if len(v) >= 3 and self.fts:
+                    s = s.filter(self._fts_match('asn_desc', v))
+                else:
+                    s = s.filter(Indicator.asn_desc.like('%{}%'.format(v)))
 
             elif k == 'cc':
                 s = s.filter(Indicator.cc == v)
@@ -426,16 +668,34 @@ class IndicatorManager(IndicatorManagerPlugin):
                 s = s.filter(Indicator.uuid == v)
 
             elif k == 'tags':
-                t = v.split(',')
-                s = s.outerjoin(Tag)
-                s = s.filter(or_(Tag.tag == tt for tt in t))
+                s = s.filter(self._filter_tags(v))
 
             else:
                 raise InvalidSearch('invalid filter: %s' % k)
 
         return s
 
-    def _filter_groups(self, filters, token, s):
+    def _filter_tags(self, v):
+        # 'a,b' is any of, 'a+b' (or 'a b', query strings decode + to a space) is all of
+        if isinstance(v, str):
+            v = v.split(',')
+
+        any_of = []
+        all_of = []
+        for t in v:
+            t = [tt for tt in re.split(r'[+ ]', t.strip()) if tt]
+            if len(t) == 1:
+                any_of.append(t[0])
+            elif t:
+                all_of.append(and_(Indicator.tags.any(Tag.tag == tt) for tt in t))
+
+        # semi-joins against ix_tags_indicator, one row per indicator whatever its tag count
+        if any_of:
+            all_of.append(Indicator.tags.any(Tag.tag.in_(any_of)))
+
+        return or_(*all_of)
+
+    def _filter_groups(self, filters, token, s, indexed=True):
         if token:
             groups = token.get('groups', 'everyone')
         else:
@@ -444,33 +704,110 @@ class IndicatorManager(IndicatorManagerPlugin):
         if isinstance(groups, str):
             groups = [groups]
 
-        s = s.filter(or_(Indicator.group == g for g in groups))
+        # indicator lookups are driven from the itype tables, a unary + keeps sqlite off the group indexes
+        # (without stats it would rather walk the whole group in reported_at order than sort a handful of rows)
+        c = Indicator.group
+        if not indexed:
+            c = UnaryExpression(c, operator=custom_op('+'))
+
+        s = s.filter(or_(c == g for g in groups))
         return s
 
-    def _search_bulk(self, filters, token):
-        s = self.handle().query(Indicator)
+    def _bulk_ranges(self, itype, i):
+        # the same matches _filter_indicator makes, as index ranges
+        if itype in ['fqdn', 'email']:
+            rev = reverse_labels(i)
+            return [(rev, rev, None, None), (rev + '.', rev + '/', None, None)]
 
-        s = s.filter(or_(Indicator.indicator == i['indicator']
-                         for i in filters))
+        if itype == 'ipv4':
+            ip = ipaddress.IPv4Network(i, strict=False)
+            if ip.prefixlen < 8:
+                raise InvalidSearch('prefix needs to be >= 8')
 
-        groups = token.get('groups', 'everyone')
-        if isinstance(groups, str):
-            groups = [groups]
+            start, end = ip_range(ip)
+            starts = set(int(ip.supernet(new_prefix=m).network_address) for m in range(0, ip.prefixlen + 1))
 
-        s = s.filter(or_(Indicator.group == g for g in groups))
-        return s
+            return [(start, end, end, 0)] + [(s, s, end, 1) for s in starts]
+
+        if itype in HASH_TYPES:
+            i = i.lower()
+
+        return [(i, i, None, None)]
+
+    def _search_bulk(self, token, itype, keys):
+        # one query per itype, the keys go in a temp table and each row probes the itype index
+        s = self.handle()
+        k = BULK_KEYS.c
+        table, col = BULK_COLUMNS[itype]
+
+        match = col.between(k.lo, k.hi)
+        if itype == 'ipv4':
+            match = and_(match, or_(and_(k.c == 0, Ipv4.ip_end <= k.e), and_(k.c == 1, Ipv4.ip_end >= k.e)))
+
+        # an indicator can match more than one range of the same key, rank them once per key
+        rank = func.row_number().over(partition_by=k.k, order_by=desc(func.max(Indicator.reported_at)))
+
+        hits = s.query(k.k.label('k'), Indicator.id.label('id'), func.max(k.n).label('n'), rank.label('rank'))\
+            .select_from(BULK_KEYS).join(table, match).join(Indicator, Indicator.id == table.indicator_id)
+
+        hits = self._filter_groups({}, token, hits, indexed=False).group_by(k.k, Indicator.id).subquery()
+
+        q = s.query(hits.c.k, *INDICATOR_SEARCH_COLUMNS).join(Indicator, Indicator.id == hits.c.id)\
+            .filter(hits.c.rank <= hits.c.n).order_by(hits.c.k, hits.c.rank)
+
+        s.execute(BULK_KEYS_SQL)
+        try:
+            s.execute(BULK_KEYS.insert(), [
+                {'k': i, 'lo': lo, 'hi': hi, 'e': e, 'c': c, 'n': n}
+                for i, n in keys for lo, hi, e, c in self._bulk_ranges(itype, i)
+            ])
+            rows = q.all()
+
+        finally:
+            # the key inserts open a transaction, ending it drops the keys and lets go of the snapshot, a wal
+            # reader would otherwise never see another write
+            s.rollback()
+
+        for r, d in zip(rows, serialize_indicators(r[1:] for r in rows)):
+            d['tags'] = d['tags'].split(',') if d.get('tags') else []
+            yield r[0], d
+
+    def search_bulk(self, token, filters, limit=500):
+        # results keyed by the input indicator, each key gets its own limit
+        rv = {}
+        itypes = {}
+        for f in filters:
+            i = f['indicator']
+            rv[i] = []
+
+            try:
+                itype = resolve_itype(i)
+            except TypeError:
+                itype = None
+
+            # ipv6 and free text go through the single search
+            if itype not in BULK_COLUMNS:
+                rv[i] = self.search(token, dict(f), limit=limit)
+                continue
+
+            itypes.setdefault(itype, []).append((i, int(f.get('limit', limit))))
+
+        for itype, keys in itypes.items():
+            for i, d in self._search_bulk(token, itype, keys):
+                rv[i].append(d)
+
+        return rv
 
     def _search(self, filters, token):
         myfilters = dict(filters.items())
 
         s = self.handle().query(Indicator)
+        indexed = not myfilters.get('indicator')
 
         # if no tags are presented, users probably expect non special data
         # in their results
         if not myfilters.get('tags') and not myfilters.get('indicator'):
-            s = s.outerjoin(Tag)
-            s = s.filter(Tag.tag != 'pdns')
-            s = s.filter(Tag.tag != 'search')
+            s = s.filter(~Indicator.tags.any(Tag.tag.in_(['pdns', 'search'])))
 
         # these functions taint myfilters...
         s = self._filter_indicator(myfilters, s)
@@ -478,9 +815,9 @@ class IndicatorManager(IndicatorManagerPlugin):
 
         # group support
         if myfilters.get('groups'):
-            return self._filter_groups(myfilters, None, s)
+            return self._filter_groups(myfilters, None, s, indexed=indexed)
 
-        return self._filter_groups({}, token, s)
+        return self._filter_groups({}, token, s, indexed=indexed)
 
     def _cleanup_timestamps(self, i):
         if not i.get('last_at'):
@@ -492,18 +829,97 @@ class IndicatorManager(IndicatorManagerPlugin):
         if not i.get('first_at'):
             i['first_at'] = i['last_at']
 
-    def search(self, token, filters, limit=500):
-        if isinstance(filters, list) and len(filters) > 1:
-            s = self._search_bulk(filters, token).limit(500)
-            return [self.to_dict(i) for i in s]
+    def _load_messages(self, rv, ids=None):
+        q = self.handle().query(Message.indicator_id, Message.message)
+        if ids is None:
+            q = q.filter(Message.indicator_id.in_([d['id'] for d in rv]))
+        else:
+            q = q.join(ids, ids.c.id == Message.indicator_id)
+
+        messages = {}
+        for id, m in q:
+            if isinstance(m, str):
+                m = m.encode('utf-8')
+
+            messages.setdefault(id, []).append(b64encode(m))
+
+        for d in rv:
+            d['message'] = messages.get(d['id'], [])
+
+    def _to_dicts(self, s, messages=False):
+        rv = serialize_indicators(s.with_entities(*INDICATOR_SEARCH_COLUMNS))
+
+        for d in rv:
+            d['tags'] = d['tags'].split(',') if d.get('tags') else []
+
+        # messages cost another pass over the base query, only when asked for
+        if messages and rv:
+            self._load_messages(rv, ids=s.with_entities(Indicator.id).subquery())
+
+        return rv
+
+    def _chunks(self, s, size, messages=False):
+        rows = iter(s.with_entities(*INDICATOR_SEARCH_COLUMNS).yield_per(size))
+
+        while True:
+            rv = serialize_indicators(islice(rows, size))
+            if not rv:
+                return
+
+            for d in rv:
+                d['tags'] = d['tags'].split(',') if d.get('tags') else []
+
+            if messages:
+                self._load_messages(rv)
+
+            yield rv
+
+    def _search_ordered(self, token, filters, limit):
+        messages = filters.pop('messages', False) in ['1', 'True', 1, True]
 
         s = self._search(filters, token)
 
         limit = filters.pop('limit', limit)
 
-        rv = s.order_by(desc(Indicator.reported_at)).limit(limit)
+        return s.order_by(desc(Indicator.reported_at)).limit(limit), messages
+
+    def search(self, token, filters, limit=500):
+        if isinstance(filters, list) and len(filters) > 1:
+            return self.search_bulk(token, filters, limit=limit)
+
+        s, messages = self._search_ordered(token, filters, limit)
+
+        return self._to_dicts(s, messages=messages)
+
+    def search_chunks(self, token, filters, size=500, limit=500):
+        # bulk results are keyed by input, they go out as one chunk
+        if isinstance(filters, list) and len(filters) > 1:
+            return (rv for rv in [self.search_bulk(token, filters, limit=limit)])
+
+        # the query is built here so bad filters raise before the first chunk goes out
+        s, messages = self._search_ordered(token, filters, limit)
 
-        return [self.to_dict(i) for i in rv]
+        return self._chunks(s, size, messages=messages)
+
+    def _query_plan(self, q):
+        c = q.statement.compile(dialect=self.engine.dialect)
+        params = [c.construct_params()[k] for k in c.positiontup]
+
+        return [r[-1] for r in self.engine.execute('EXPLAIN QUERY PLAN ' + str(c), params)]
+
+    def explain(self, groups='everyone', limit=500):
+        rv = []
+        for name, filters, ordered in EXPLAIN_SHAPES:
+            s = self._search(dict(filters, groups=groups), None)
+            plan = self._query_plan(s.order_by(desc(Indicator.reported_at)).limit(limit))
+
+            flags = ['full scan: {}'.format(l) for l in plan if l.startswith('SCAN ') and 'CONSTANT ROW' not in l]
+            if ordered:
+                flags += ['sort: {}'.format(l) for l in plan if 'TEMP B-TREE' in l]
+
+            rv.append((name, plan, flags))
+
+        return rv
 
     def delete(self, token, data=None):
         if type(data) is not list:
@@ -529,30 +945,34 @@ class IndicatorManager(IndicatorManagerPlugin):
         if i.itype == 'ipv4':
             match = re.search('^(\S+)\/(\d+)$', i.indicator)  # TODO -- use ipaddress
             if match:
-                ipv4 = Ipv4(ipv4=match.group(1), mask=match.group(2), indicator=i)
+                ipv4 = Ipv4(ipv4=match.group(1), mask=match.group(2), indicator=i, **ip_range_columns(i.indicator))
             else:
-                ipv4 = Ipv4(ipv4=i.indicator, indicator=i)
+                ipv4 = Ipv4(ipv4=i.indicator, indicator=i, **ip_range_columns(i.indicator))
 
             s.add(ipv4)
 
         elif i.itype == 'ipv6':
             match = re.search('^([\S|:]+)\/(\d+)$', i.indicator)  # TODO -- use ipaddress
             if match:
-                ip = Ipv6(ip=match.group(1), mask=match.group(2), indicator=i)
+                ip = Ipv6(ip=match.group(1), mask=match.group(2), indicator=i, **ip_range_columns(i.indicator))
             else:
-                ip = Ipv6(ip=i.indicator, indicator=i)
+                ip = Ipv6(ip=i.indicator, indicator=i, **ip_range_columns(i.indicator))
 
             s.add(ip)
 
         elif i.itype == 'fqdn':
-            fqdn = Fqdn(fqdn=i.indicator, indicator=i)
+            fqdn = Fqdn(fqdn=i.indicator, fqdn_rev=reverse_labels(i.indicator), indicator=i)
             s.add(fqdn)
 
+        elif i.itype == 'email':
+            email = Email(email=i.indicator, email_rev=reverse_labels(i.indicator), indicator=i)
+            s.add(email)
+
         elif i.itype == 'url':
             url = Url(url=i.indicator, indicator=i)
             s.add(url)
 
-        elif i.itype == HASH_TYPES:
+        elif i.itype in HASH_TYPES:
             h = Hash(hash=i.indicator, indicator=i)
             s.add(h)
 
@@ -584,46 +1004,67 @@ class IndicatorManager(IndicatorManagerPlugin):
 
         return tags
 
-    def _upsert_filter(self, s, d, tags):
-        # setup query
-        i = s.query(Indicator).options(lazyload('*')).filter_by(
-            provider=d['provider'],
-            itype=d['itype'],
-            indicator=d['indicator'],
-        ).order_by(Indicator.last_at.desc())
-
-        if d.get('rdata'):
-            i = i.filter_by(rdata=d['rdata'])
-
-        if d['itype'] == 'ipv4':
-            match = re.search('^(\S+)\/(\d+)$', d['indicator'])  # TODO -- use ipaddress
-            if match:
-                i = i.join(Ipv4).filter(Ipv4.ipv4 == match.group(1), Ipv4.mask == match.group(2))
-            else:
-                i = i.join(Ipv4).filter(Ipv4.ipv4 == d['indicator'])
-
-        elif d['itype'] == 'ipv6':
-            match = re.search('^(\S+)\/(\d+)$', d['indicator'])  # TODO -- use ipaddress
-            if match:
-                i = i.join(Ipv6).filter(Ipv6.ip == match.group(1), Ipv6.mask == match.group(2))
-            else:
-                i = i.join(Ipv6).filter(Ipv6.ip == d['indicator'])
+    def _upsert_prefetch(self, s, data):
+        # resolve every existing record for the batch in a handful of set
+        # based queries (one per itype per chunk) instead of one per indicator
+        wanted = {}
+        for d in data:
+            if not d.get('itype') or not d.get('indicator'):
+                continue
 
-        elif d['itype'] == 'fqdn':
-            i = i.join(Fqdn).filter(Fqdn.fqdn == d['indicator'])
+            wanted.setdefault(d['itype'], {}).setdefault(d['indicator'], set()).add(d.get('provider'))
+
+        existing = {}
+        for itype, indicators in wanted.items():
+            indicators = list(indicators.items())
+            for idx in range(0, len(indicators), PREFETCH_CHUNK):
+                chunk = indicators[idx:idx + PREFETCH_CHUNK]
+                providers = set()
+                for _, p in chunk:
+                    providers |= p
+
+                q = s.query(Indicator, Tag.tag).options(lazyload('*')).filter(
+                    Indicator.itype == itype,
+                    Indicator.indicator.in_([i for i, _ in chunk]),
+                    Indicator.provider.in_(list(providers)),
+                )
+
+                if ITYPE_TABLES.get(itype):
+                    q = q.join(ITYPE_TABLES[itype])
+
+                q = q.outerjoin(Tag, Tag.indicator_id == Indicator.id)
+
+                records = {}
+                for r, tag in q:
+                    if r.id not in records:
+                        records[r.id] = (r, set())
+                        existing.setdefault((r.provider, r.itype, r.indicator), []).append(records[r.id])
+
+                    if tag:
+                        records[r.id][1].add(tag)
+
+        return existing
+
+    def _upsert_match(self, existing, d, tags):
+        # same rules the old per-row query used: provider/itype/indicator,
+        # rdata (if given) and the first tag (if given), newest last_at wins
+        r = None
+        for rr, rr_tags in existing.get((d['provider'], d['itype'], d['indicator']), []):
+            if d.get('rdata') and rr.rdata != d['rdata']:
+                continue
 
-        elif d['itype'] == 'url':
-            i = i.join(Url).filter(Url.url == d['indicator'])
+            if len(tags) and tags[0] not in rr_tags:
+                continue
 
-        elif d['itype'] in HASH_TYPES:
-            i = i.join(Hash).filter(Hash.hash == d['indicator'])
+            if r is None or (rr.last_at and (not r.last_at or arrow.get(rr.last_at) > arrow.get(r.last_at))):
+                r = rr
 
-        if len(tags):
-            i = i.join(Tag).filter(Tag.tag == tags[0])
+        return r
 
-        return i
+    def _upsert(self, s, n, d, token, cached_added, existing):
+        # work on a copy, the batch may be replayed if it fails
+        d = dict(d)
 
-    def _upsert(self, s, n, d, token, cached_added, batch):
         try:
             # check to see if it's been added in the cache
             if cached_added.get(d['indicator']):
@@ -639,12 +1080,7 @@ class IndicatorManager(IndicatorManagerPlugin):
 
             tags = self._normalize_tags(d)
 
-            i = self._upsert_filter(s, d, tags)
-
-            # get first indicator
-            r = i.first()
-            if r and not isinstance(r, Indicator):
-                r = r.get(i.indicator_id)
+            r = self._upsert_match(existing, d, tags)
 
             # if the record exists.. and if it's newer, skip
             if r:
@@ -686,6 +1122,9 @@ class IndicatorManager(IndicatorManagerPlugin):
 
             self._upsert_itype(s, ii)
 
+            # make it visible to the rest of the batch
+            existing.setdefault((ii.provider, ii.itype, ii.indicator), []).append((ii, set(tags)))
+
             cached_added[d['indicator']].add(d['last_at'])
 
         except Exception as e:
@@ -695,67 +1134,197 @@ class IndicatorManager(IndicatorManagerPlugin):
                 import traceback
                 traceback.print_exc()
 
-            if batch:
-                logger.debug('Failing batch - passing exception to upper layer')
-                raise
+            logger.debug('Failing batch - passing exception to upper layer')
+            raise
+
+        return n
+
+    def _bind(self, table, col, value):
+        p = self._processors[table][col]
+        if p is None or value is None:
+            return value
+
+        return p(value)
+
+    def _native_row(self, d):
+        r = {c: d.get(c) for c in INDICATOR_COLUMNS}
+        r['group'] = d.get('group', 'everyone')
+        r['portlist'] = str(d.get('portlist', None))
+
+        for k in ['reported_at', 'first_at', 'last_at']:
+            if r[k] is not None:
+                r[k] = arrow.get(r[k]).datetime.replace(tzinfo=None)
+
+        for k in ['peers', 'additional_data']:
+            if r[k] is not None:
+                r[k] = json.dumps(r[k])
+
+        return {c: self._bind('indicators', c, v) for c, v in r.items()}
+
+    def _native_itype(self, itype, indicator):
+        if itype in ['ipv4', 'ipv6']:
+            ip, _, mask = indicator.partition('/')
+            if itype == 'ipv4':
+                return Ipv4, dict(ipv4=ip, mask=int(mask or 32), **ip_range_columns(indicator))
+
+            return Ipv6, dict(ip=ip, mask=int(mask or 64), **ip_range_columns(indicator))
+
+        if itype == 'fqdn':
+            return Fqdn, {'fqdn': indicator, 'fqdn_rev': reverse_labels(indicator)}
+
+        if itype == 'email':
+            return Email, {'email': indicator, 'email_rev': reverse_labels(indicator)}
+
+        if itype == 'url':
+            return Url, {'url': indicator}
+
+        if itype in HASH_TYPES:
+            return Hash, {'hash': indicator}
+
+        return None, None
+
+    def _native_lookup(self, cur, keys):
+        indicators = list(set(k[2] for k in keys))
+
+        rv = {}
+        for idx in range(0, len(indicators), PREFETCH_CHUNK):
+            chunk = indicators[idx:idx + PREFETCH_CHUNK]
+            cur.execute("""
+                SELECT id, provider, itype, indicator, ifnull(rdata, ''), last_at FROM indicators
+                WHERE indicator IN ({})
+            """.format(','.join('?' * len(chunk))), chunk)
+
+            for r in cur.fetchall():
+                if r[1:5] in keys:
+                    rv[r[1:5]] = (r[0], r[5])
+
+        return rv
+
+    def _upsert_native(self, s, data, token):
+        rows = []
+        for d in data:
+            d = dict(d)
+            if d.get('rdata', '') != '' and isinstance(d['rdata'], list):
+                d['rdata'] = ','.join(d['rdata'])
+
+            self._cleanup_timestamps(d)
+            tags = self._normalize_tags(d)
+
+            r = self._native_row(d)
+            k = (r['provider'], r['itype'], r['indicator'], r['rdata'] or '')
+            rows.append((k, r, tags, d.get('message')))
+
+        keys = set(k for k, _, _, _ in rows)
+
+        cur = s.connection().connection.cursor()
+
+        before = self._native_lookup(cur, keys)
+        cur.executemany(NATIVE_UPSERT_SQL, [[r[c] for c in INDICATOR_COLUMNS] for _, r, _, _ in rows])
+        after = self._native_lookup(cur, keys)
+
+        n = 0
+        children = {}
+        tags_new = []
+        messages = []
+        for k, r, tags, message in rows:
+            id, _ = after[k]
+            prev = before.get(k)
+
+            if prev is None:
+                t, values = self._native_itype(r['itype'], r['indicator'])
+                if t is not None:
+                    children.setdefault(t, []).append((values, id))
+
             else:
+                # existing record, same accounting as the orm path
                 n -= 1
-                logger.debug('Rolling back individual transaction..')
-                s.rollback()
+                if prev[1] is not None and r['last_at'] <= prev[1]:
+                    logger.debug('skipping: %s' % r['indicator'])
+                    continue
 
-        # When this function is called in non-batch mode, we need to commit each individual indicator at this point.
-        # For batches, the commit happens at a higher layer.
+            before[k] = (id, r['last_at'])
 
-        if not batch:
-            try:
-                logger.debug('Committing individual indicator')
-                s.commit()
-            except Exception as e:
-                if logger.getEffectiveLevel() == logging.DEBUG:
-                    import traceback
-                    traceback.print_exc()
+            for t in tags:
+                tags_new.append((t, id, t, id))
 
-                n -= 1
-                logger.error(e)
-                logger.debug('Rolling back individual transaction..')
-                s.rollback()
+            if message:
+                messages.append((message, id))
 
-        return n
+        for t, values in children.items():
+            cols = [c.name for c in t.__table__.c if c.name not in ['id', 'indicator_id']]
+            values = [[self._bind(t.__tablename__, c, v.get(c)) for c in cols] + [id] for v, id in values]
+            cur.executemany('INSERT INTO {} ({}, indicator_id) VALUES ({}, ?)'.format(
+                t.__tablename__, ', '.join(cols), ', '.join('?' * len(cols))), values)
 
-    def upsert(self, token, data, **kwargs):
-        if isinstance(data, dict):
-            data = [data]
+        cur.executemany("""
+            INSERT INTO tags (tag, indicator_id) SELECT ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM tags WHERE tag = ? AND indicator_id = ?)
+        """, tags_new)
 
-        s = self.handle()
+        cur.executemany('INSERT INTO messages (message, indicator_id) VALUES (?, ?)', messages)
 
+        return n
+
+    def _upsert_orm(self, s, data, token):
         n = 0
         cached_added = {}
 
         s1 = time.time()
+        existing = self._upsert_prefetch(s, data)
+        logger.debug('prefetched %d existing records: %0.2f' % (len(existing), time.time() - s1))
+
+        for d in data:
+            n = self._upsert(s, n, d, token, cached_added, existing)
+
+        return n
+
+    def _upsert_bisect(self, s, data, token, batch, rejected):
         try:
-            for d in data:
-               n = self._upsert(s, n, d, token, cached_added, True)
+            n = batch(s, data, token)
 
-            logger.debug('committing entire batch')
-            s2 = time.time()
+            logger.debug('committing batch of %d' % len(data))
             s.commit()
-            logger.debug('done: %0.2f' % (time.time() - s2))
+            return n
 
         except Exception as e:
             if logger.getEffectiveLevel() == logging.DEBUG:
                 import traceback
                 traceback.print_exc()
 
-            n = 0
-            cached_added = {}
             logger.error(e)
             logger.debug('rolling back transaction..')
             s.rollback()
-            logger.debug('Trying batch again in non-batch mode')
-            for d in data:
-                n = self._upsert(s, n, d, token, cached_added, False)
 
-        if n < 0:
-            return abs(n)
+        if len(data) == 1:
+            logger.error('rejecting indicator: %s' % data[0].get('indicator'))
+            rejected.append(data[0])
+            return 0
 
-        return n
+        # split the batch, only the halves with bad rows get split further
+        mid = len(data) // 2
+        logger.debug('bisecting failed batch of %d' % len(data))
+
+        n = self._upsert_bisect(s, data[:mid], token, batch, rejected)
+        return n + self._upsert_bisect(s, data[mid:], token, batch, rejected)
+
+    def upsert(self, token, data, rejected=None, **kwargs):
+        if isinstance(data, dict):
+            data = [data]
+
+        if rejected is None:
+            rejected = []
+
+        s = self.handle()
+
+        batch = self._upsert_orm
+        if self.upsert_mode == 'native':
+            batch = self._upsert_native
+
+        s1 = time.time()
+        n = self._upsert_bisect(s, data, token, batch, rejected)
+        logger.debug('done: %0.2f' % (time.time() - s1))
+
+        if rejected:
+            logger.error('rejected %d of %d indicators' % (len(rejected), len(data)))
+
+        return abs(n)
@@ -0,0 +1,221 @@
+import ipaddress
+import logging
+
+logger = logging.getLogger('cif.store.sqlite')
+
+# provider, itype, indicator, rdata- NULL rdata must collide with NULL rdata, sqlite treats NULLs as distinct
+NATURAL_KEY = ('provider', 'itype', 'indicator', "ifnull(rdata, '')")
+NATURAL_KEY_INDEX = 'ux_indicators_natural_key'
+
+
+def index_exists(conn, name):
+    rv = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone()
+    return rv is not None
+
+
+def column_exists(conn, table, column):
+    for c in conn.execute('PRAGMA table_info("{}")'.format(table)):
+        if c[1] == column:
+            return True
+
+
+def add_column(conn, table, column, ddl):
+    if column_exists(conn, table, column):
+        return False
+
+    logger.info('adding column {}.{}'.format(table, column))
+    conn.execute('ALTER TABLE "{}" ADD COLUMN {} {}'.format(table, column, ddl))
+    return True
+
+
+def create_index(conn, name, table, columns, unique=False):
+    # create_all() only builds indexes for new tables, existing dbs get them here
+    if index_exists(conn, name):
+        return False
+
+    logger.info('creating index {}'.format(name))
+    conn.execute('CREATE {}INDEX IF NOT EXISTS {} ON "{}" ({})'.format(
+        'UNIQUE ' if unique else '', name, table, ', '.join(columns)))
+    return True
+
+
+def add_reversed_labels(conn, table, column, reverse):
+    # <column>_rev holds the labels reversed (com.example.www), backfilled once when the column is added
+    rev = '{}_rev'.format(column)
+    if add_column(conn, table, rev, 'TEXT'):
+        conn.create_function('reverse_labels', 1, reverse)
+        conn.execute('UPDATE "{}" SET {} = reverse_labels({})'.format(table, rev, column))
+
+    return create_index(conn, 'ix_{}_{}'.format(table, rev), table, [rev])
+
+
+def add_ip_ranges(conn, table, column, ranges, range_columns):
+    added = [add_column(conn, table, c, 'INTEGER') for c in ranges]
+
+    if any(added):
+        rows = conn.execute('SELECT id, {}, mask FROM "{}"'.format(column, table)).fetchall()
+        values = []
+        for id, ip, mask in rows:
+            ip = str(ipaddress.ip_address(ip))
+            if mask:
+                ip = '{}/{}'.format(ip, mask)
+
+            r = range_columns(ip)
+            values.append([r[c] for c in ranges] + [id])
+
+        conn.executemany('UPDATE "{}" SET {} WHERE id = ?'.format(
+            table, ', '.join('{} = ?'.format(c) for c in ranges)), values)
+
+    return create_index(conn, 'ix_{}_range'.format(table), table, ranges)
+
+
+def add_hashes(conn, table, itypes):
+    # hash indicators went in without their <table> rows for a while, backfilled once when the indicator_id
+    # index is added (new dbs get it from create_all, with nothing to backfill)
+    if not create_index(conn, 'ix_{}_indicator_id'.format(table), table, ['indicator_id']):
+        return False
+
+    n = conn.execute("""
+        INSERT INTO "{0}" (hash, indicator_id)
+        SELECT lower(i.indicator), i.id FROM indicators i
+        WHERE i.itype IN ({1}) AND NOT EXISTS (SELECT 1 FROM "{0}" h WHERE h.indicator_id = i.id)
+    """.format(table, ','.join('?' * len(itypes))), list(itypes)).rowcount
+
+    if n:
+        logger.info('backfilled {} {} rows'.format(n, table))
+
+    return True
+
+
+def add_emails(conn, table, reverse):
+    # email indicators went in without their <table> rows, backfilled once when the indicator_id index is added
+    if not create_index(conn, 'ix_{}_indicator_id'.format(table), table, ['indicator_id']):
+        return False
+
+    conn.create_function('reverse_labels', 1, reverse)
+    n = conn.execute("""
+        INSERT INTO "{0}" (email, email_rev, indicator_id)
+        SELECT lower(i.indicator), reverse_labels(lower(i.indicator)), i.id FROM indicators i
+        WHERE i.itype = 'email' AND NOT EXISTS (SELECT 1 FROM "{0}" e WHERE e.indicator_id = i.id)
+    """.format(table)).rowcount
+
+    if n:
+        logger.info('backfilled {} {} rows'.format(n, table))
+
+    return True
+
+
+def dedupe_natural_key(conn):
+    # fold duplicate (provider, itype, indicator, rdata) records into the newest one so the unique index can be built
+    groups = conn.execute("""
+        SELECT group_concat(id) FROM indicators
+        GROUP BY {}
+        HAVING count(*) > 1
+    """.format(', '.join(NATURAL_KEY))).fetchall()
+
+    n = 0
+    for g, in groups:
+        ids = [int(i) for i in g.split(',')]
+        rows = conn.execute("""
+            SELECT id, ifnull(count, 1) FROM indicators WHERE id IN ({})
+            ORDER BY last_at DESC, id DESC
+        """.format(','.join('?' * len(ids))), ids).fetchall()
+
+        keep = rows[0][0]
+        drop = [r[0] for r in rows[1:]]
+        marks = ','.join('?' * len(drop))
+
+        conn.execute("""
+            UPDATE tags SET indicator_id = ? WHERE indicator_id IN ({}) AND tag NOT IN (
+                SELECT tag FROM tags WHERE indicator_id = ?)
+        """.format(marks), [keep] + drop + [keep])
+
+        conn.execute('UPDATE messages SET indicator_id = ? WHERE indicator_id IN ({})'.format(marks), [keep] + drop)
+        conn.execute('UPDATE indicators SET count = ? WHERE id = ?', (sum(r[1] for r in rows), keep))
+        conn.execute('DELETE FROM indicators WHERE id IN ({})'.format(marks), drop)
+        n += len(drop)
+
+    return n
+
+
+def create_natural_key_index(conn):
+    if index_exists(conn, NATURAL_KEY_INDEX):
+        return False
+
+    n = dedupe_natural_key(conn)
+    if n:
+        logger.info('merged {} duplicate indicators'.format(n))
+
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS {} ON indicators ({})'.format(
+        NATURAL_KEY_INDEX, ', '.join(NATURAL_KEY)))
+    return True
+
+
+FTS_TABLE = 'indicators_fts'
+
+FTS_TRIGGERS = {
+    'indicators_fts_ai': """
+        AFTER INSERT ON indicators BEGIN
+            INSERT INTO indicators_fts (rowid, description, asn_desc, message)
+            VALUES (new.id, new.description, new.asn_desc, '');
+        END""",
+    'indicators_fts_au': """
+        AFTER UPDATE OF description, asn_desc ON indicators BEGIN
+            UPDATE indicators_fts SET description = new.description, asn_desc = new.asn_desc WHERE rowid = new.id;
+        END""",
+    'indicators_fts_ad': """
+        AFTER DELETE ON indicators BEGIN
+            DELETE FROM indicators_fts WHERE rowid = old.id;
+        END""",
+    'messages_fts_ai': """
+        AFTER INSERT ON messages BEGIN
+            UPDATE indicators_fts SET message = message || ' ' || CAST(new.message AS TEXT)
+            WHERE rowid = new.indicator_id;
+        END""",
+}
+
+
+def table_exists(conn, name):
+    rv = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    return rv is not None
+
+
+def create_fts(conn):
+    # fts5 shadow index over description, asn_desc and messages, kept in sync by triggers. only the trigram
+    # tokenizer (sqlite 3.34+) keeps LIKE's substring matching, other tokenizers match whole words
+    if table_exists(conn, FTS_TABLE):
+        return True
+
+    try:
+        conn.execute("CREATE VIRTUAL TABLE {} USING fts5(description, asn_desc, message, tokenize='trigram')".format(
+            FTS_TABLE))
+
+    except Exception as e:
+        logger.warning('fts5 with the trigram tokenizer is not available in this sqlite build ({}), description, '
+                       'asn_desc and message searches keep using LIKE'.format(e))
+        return False
+
+    logger.info('building {}...'.format(FTS_TABLE))
+    conn.execute("""
+        INSERT INTO indicators_fts (rowid, description, asn_desc, message)
+        SELECT i.id, i.description, i.asn_desc, ifnull((
+            SELECT group_concat(CAST(m.message AS TEXT), ' ') FROM messages m WHERE m.indicator_id = i.id), '')
+        FROM indicators i
+    """)
+
+    for name, ddl in FTS_TRIGGERS.items():
+        conn.execute('CREATE TRIGGER IF NOT EXISTS {} {}'.format(name, ddl))
+
+    return True
+
+
+def drop_fts(conn):
+    if not table_exists(conn, FTS_TABLE):
+        return False
+
+    logger.info('dropping {}'.format(FTS_TABLE))
+    for name in FTS_TRIGGERS:
+        conn.execute('DROP TRIGGER IF EXISTS {}'.format(name))
+
+    conn.execute('DROP TABLE {}'.format(FTS_TABLE))
+    return True
@@ -1,12 +1,26 @@
 import logging
+import os
+import hmac
+import hashlib
 import arrow
-from sqlalchemy import Column, Integer, String, DateTime, UnicodeText, Boolean, or_, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, UnicodeText, Boolean, or_, ForeignKey, bindparam
 from sqlalchemy.orm import class_mapper, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 from cif.store.plugin.token import TokenManagerPlugin
+from .migrations import add_column, create_index
 
 logger = logging.getLogger('cif.store.sqlite')
 
+# tokens are looked up by hmac-sha256(key, token), set a key so the hashes can't be checked offline
+TOKEN_KEY = os.getenv('CIF_STORE_TOKEN_KEY', '')
+
+# keep only the hash, tokens can't be read back out of the db (eg: admin_exists(), cif-tokens --search)
+TOKEN_HASH_ONLY = os.getenv('CIF_STORE_TOKEN_HASH_ONLY', '0') == '1'
+
+
+def hash_token(token, key=TOKEN_KEY):
+    return hmac.new(key.encode('utf-8'), token.encode('utf-8'), hashlib.sha256).hexdigest()
+
 Base = declarative_base()
 
 
@@ -16,6 +30,7 @@ class Token(Base):
     id = Column(Integer, primary_key=True)
     username = Column(UnicodeText)
     token = Column(String)
+    token_hash = Column(String, index=True)
     expires = Column(DateTime)
     read = Column(Boolean)
     write = Column(Boolean)
@@ -45,14 +60,48 @@ class Group(Base):
 
 class TokenManager(TokenManagerPlugin):
 
-    def __init__(self, handle, engine, **kwargs):
+    def __init__(self, handle, engine, readonly=False, hash_only=TOKEN_HASH_ONLY, **kwargs):
         super(TokenManager, self).__init__(**kwargs)
         self.handle = handle
-        Base.metadata.create_all(engine)
+        self.readonly = readonly
+        self.hash_only = hash_only
+
+        if not readonly:
+            if not TOKEN_KEY:
+                logger.warning('CIF_STORE_TOKEN_KEY is not set, token hashes are plain sha256 and can be checked '
+                               'offline')
+
+            if not TOKEN_KEY and not hash_only:
+                logger.warning('tokens are also kept in plaintext, set CIF_STORE_TOKEN_HASH_ONLY=1 to drop them')
+
+            Base.metadata.create_all(engine)
+            self._migrate(engine)
+
+    def _migrate(self, engine):
+        conn = engine.raw_connection()
+        try:
+            add_column(conn, 'tokens', 'token_hash', 'VARCHAR')
+
+            rows = conn.execute('SELECT id, token FROM tokens WHERE token_hash IS NULL AND token IS NOT NULL').fetchall()
+            if rows:
+                logger.info('hashing {} tokens'.format(len(rows)))
+                conn.executemany('UPDATE tokens SET token_hash = ? WHERE id = ?', [(hash_token(t), id) for id, t in rows])
+
+            create_index(conn, 'ix_tokens_token_hash', 'tokens', ['token_hash'])
+
+            if self.hash_only:
+                conn.execute('UPDATE tokens SET token = NULL WHERE token IS NOT NULL')
+
+            conn.commit()
+        finally:
+            conn.close()
 
     def to_dict(self, obj):
         d = {}
         for col in class_mapper(obj.__class__).mapped_table.c:
+            if col.name == 'token_hash':
+                continue
+
             d[col.name] = getattr(obj, col.name)
 
         try:
@@ -65,7 +114,12 @@ class TokenManager(TokenManagerPlugin):
     def search(self, data):
         s = self.handle().query(Token)
 
-        for k in ['token', 'username', 'admin', 'write', 'read']:
+        h = None
+        if data.get('token'):
+            h = hash_token(data['token'])
+            s = s.filter(Token.token_hash == h)
+
+        for k in ['username', 'admin', 'write', 'read']:
             if data.get(k):
                 s = s.filter_by(**{k: data[k]})
 
@@ -75,13 +129,15 @@ class TokenManager(TokenManagerPlugin):
 
         # update the cache
         for x in s:
-            if x.token not in self._cache:
-                self._cache[x.token] = self.to_dict(x)
-                self._cache[x.token]['groups'] = []
-                for g in x.groups:
-                    self._cache[x.token]['groups'].append(g.group)
+            rv = self.to_dict(x)
+            if h:
+                rv['token'] = data['token']
 
-            yield self._cache[x.token]
+            if not rv['token']:
+                yield rv
+                continue
+
+            yield self._cache_set(rv['token'], rv)
 
     def create(self, data):
         s = self.handle()
@@ -95,7 +151,8 @@ class TokenManager(TokenManagerPlugin):
 
         t = Token(
             username=data.get('username'),
-            token=data['token'],
+            token=None if self.hash_only else data['token'],
+            token_hash=hash_token(data['token']),
             acl=acl,
             read=int(data.get('read', '0')),
             write=int(data.get('write', '0')),
@@ -117,7 +174,10 @@ class TokenManager(TokenManagerPlugin):
             s.add(gg)
 
         s.commit()
-        return self.to_dict(t)
+
+        rv = self.to_dict(t)
+        rv['token'] = data['token']
+        return rv
 
     # http://stackoverflow.com/questions/1484235/replace-delete-field-using-sqlalchemy
     def delete(self, data):
@@ -128,7 +188,7 @@ class TokenManager(TokenManagerPlugin):
             rv = rv.filter_by(username=data['username'])
 
         if data.get('token'):
-            rv = rv.filter_by(token=data['token'])
+            rv = rv.filter_by(token_hash=hash_token(data['token']))
 
         if not rv.count():
             return 0
@@ -143,7 +203,7 @@ class TokenManager(TokenManagerPlugin):
             return 'token required for updating'
 
         s = self.handle()
-        rv = s.query(Token).filter_by(token=data['token'])
+        rv = s.query(Token).filter_by(token_hash=hash_token(data['token']))
         rv.update(dict(write=data.get('write'), admin=data.get('admin'), username=data.get('username')))
 
         if not rv:
@@ -156,23 +216,35 @@ class TokenManager(TokenManagerPlugin):
 
         return True
 
-    def update_last_activity_at(self, token, timestamp=arrow.utcnow().datetime):
+    def update_last_activity_at(self, token, timestamp=None):
+        if timestamp is None:
+            timestamp = arrow.utcnow().datetime
+
         if isinstance(timestamp, str):
             timestamp = arrow.get(timestamp).datetime
 
-        if self._cache_check(token):
-            if self._cache[token].get('last_activity_at'):
-                return self._cache[token]['last_activity_at']
+        # buffered, flush_last_activity() writes them out in one transaction
+        self._activity[token] = timestamp
+
+        t = self._cache_check(token)
+        if t:
+            t['last_activity_at'] = timestamp
 
-            self._cache[token]['last_activity_at'] = timestamp
-            return timestamp
+        return timestamp
+
+    def flush_last_activity(self):
+        # store readers hand theirs to the writer
+        if self.readonly or not self._activity:
+            return 0
+
+        activity = self.pop_last_activity()
 
         s = self.handle()
-        s.query(Token).filter_by(token=token).update({Token.last_activity_at: timestamp})
+        s.execute(
+            Token.__table__.update().where(Token.token_hash == bindparam('_token')).values(
+                last_activity_at=bindparam('_ts')),
+            [{'_token': hash_token(t), '_ts': ts} for t, ts in activity.items()]
+        )
         s.commit()
 
-        t = list(self.search({'token': token}))
-
-        self._cache[token] = t[0]
-        self._cache[token]['last_activity_at'] = timestamp
-        return timestamp
+        return len(activity)
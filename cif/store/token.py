@@ -9,9 +9,17 @@ logger = logging.getLogger('cif.store')
 
 
 class TokenHandler(object):
-    def __init__(self, store):
+    def __init__(self, store, notify=None):
         self.store = store
 
+        # called with every invalidation, the store writer passes them on to the readers
+        self.notify = notify
+
+    def _invalidate(self, token=None, username=None):
+        self.store.tokens.invalidate(token=token, username=username)
+        if self.notify:
+            self.notify(token, username)
+
     def handle_tokens_search(self, token, data, **kwargs):
         if self.store.tokens.admin(token):
             return self.store.tokens.search(data)
@@ -20,13 +28,18 @@ class TokenHandler(object):
 
     def handle_tokens_create(self, token, data, **kwargs):
         if self.store.tokens.admin(token):
-            return self.store.tokens.create(data)
+            rv = self.store.tokens.create(data)
+            # drop a negative entry for a caller supplied token
+            self._invalidate(token=rv['token'])
+            return rv
 
         raise AuthError('invalid token')
 
     def handle_tokens_delete(self, token, data, **kwargs):
         if self.store.tokens.admin(token):
-            return self.store.tokens.delete(data)
+            rv = self.store.tokens.delete(data)
+            self._invalidate(token=data.get('token'), username=data.get('username'))
+            return rv
 
         raise AuthError('invalid token')
 
@@ -35,7 +48,9 @@ class TokenHandler(object):
 
     def handle_tokens_edit(self, token, data, **kwargs):
         if self.store.tokens.admin(token):
-            return self.store.tokens.edit(data)
+            rv = self.store.tokens.edit(data)
+            self._invalidate(token=data.get('token'))
+            return rv
 
         raise AuthError('invalid token')
 
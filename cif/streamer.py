@@ -1,6 +1,7 @@
 # !/usr/bin/env python3
 
 import logging
+import ujson as json
 import zmq
 import textwrap
 from argparse import ArgumentParser
@@ -43,8 +44,14 @@ class Streamer(MyProcess):
         self.publisher = None
 
     def send(self, message):
+        # subscribers get one record per message, the router hands us whole gatherer batches
         for m in message:
-            self.publisher.send(m)
+            if not m.startswith(b'['):
+                self.publisher.send(m)
+                continue
+
+            for d in json.loads(m):
+                self.publisher.send_string(json.dumps(d))
 
     def start(self):
         loop = ioloop.IOLoop()
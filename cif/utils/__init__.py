@@ -1,3 +1,4 @@
+import ujson as json
 from cifsdk.constants import RUNTIME_PATH
 from cif.constants import VERSION
 from argparse import ArgumentParser
@@ -12,3 +13,14 @@ def get_argument_parser():
         "--runtime-path", help="specify the runtime path [default %(default)s]", default=RUNTIME_PATH
     )
     return ArgumentParser(parents=[BasicArgs], add_help=False)
+
+
+def unpack_batch(frames):
+    # the router forwards gatherer payloads as it got them, each frame is one record (or search) or a list of
+    # records, bulk searches aren't forwarded so a list is always a gatherer batch
+    for f in frames:
+        d = json.loads(f)
+        if isinstance(d, list):
+            yield from d
+        else:
+            yield d
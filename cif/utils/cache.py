@@ -0,0 +1,165 @@
+import time
+from collections import OrderedDict
+
+import arrow
+import ujson as json
+from csirtg_indicator import resolve_itype
+
+
+# lru with a per entry ttl, entries are tagged (eg: by itype) so writes can drop just what they touch.
+# entries tagged None are dropped by every invalidation
+class TTLCache(object):
+
+    def __init__(self, size=512, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        e = self.entries.get(key)
+        if e is None or e[0] < time.time():
+            if e is not None:
+                self._drop(key)
+
+            self.misses += 1
+            return
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return e[2]
+
+    def set(self, key, value, tag=None):
+        if key in self.entries:
+            self._drop(key)
+
+        self.entries[key] = (time.time() + self.ttl, tag, value)
+        self.tags.setdefault(tag, set()).add(key)
+
+        while len(self.entries) > self.size:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        _, tag, _ = self.entries.pop(key)
+        keys = self.tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def invalidate(self, tags=None):
+        # everything when no tags are given
+        if tags is None:
+            keys = list(self.entries)
+        else:
+            keys = [k for t in set(tags) | {None} for k in self.tags.get(t, ())]
+
+        for k in keys:
+            self._drop(k)
+
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def metrics(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+# filters that don't change the results
+SEARCH_IGNORE = ['nocache', 'nolog']
+
+# time filters, bucketed to the ttl in the key. clients (httpd) turn days/hours into a reported_at range ending
+# now, to the second, the bucket is what lets feed pulls a few seconds apart share a reply
+SEARCH_TIMES = ['reported_at', 'first_at', 'last_at']
+
+
+# indicators_search replies by (token, filters). the router only sees the client id on a reply, so it notes what
+# each client is waiting on and collects the (streamed) reply chunks for it until the last one
+class SearchCache(TTLCache):
+
+    def __init__(self, size=512, ttl=30, max_bytes=8 * 1024 * 1024, max_pending=10000):
+        super(SearchCache, self).__init__(size=size, ttl=ttl)
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+
+        # client id -> [(key, itype) or None, replies outstanding, chunks, bytes]
+        self.pending = {}
+
+    def _bucket(self, v):
+        try:
+            return ','.join(str(arrow.get(t).timestamp // self.ttl) for t in str(v).split(','))
+        except Exception:
+            return str(v)
+
+    def key(self, token, data):
+        # (key, itype), key is None for searches that can't (bulk) or shouldn't (nocache) be cached
+        try:
+            filters = json.loads(data)
+        except ValueError:
+            return None, None
+
+        if not isinstance(filters, dict) or filters.get('nocache') in ['1', 'True', 1, True]:
+            return None, None
+
+        itype = filters.get('itype')
+        if not itype and filters.get('indicator'):
+            try:
+                itype = resolve_itype(filters['indicator'])
+            except Exception:
+                itype = None
+
+        key = []
+        for k, v in filters.items():
+            if k in SEARCH_IGNORE:
+                continue
+
+            key.append((k, self._bucket(v) if k in SEARCH_TIMES else str(v)))
+
+        return (token, tuple(sorted(key))), itype
+
+    def wait(self, id, key=None, itype=None):
+        # a client with more than one read outstanding (a dealer) can't have its replies told apart, none of
+        # them are cached
+        p = self.pending.get(id)
+        if p:
+            p[0] = None
+            p[1] += 1
+            return
+
+        self.pending[id] = [(key, itype) if key else None, 1, [], 0]
+
+        # replies lost to a store restart would leave their entries here, drop the oldest
+        while len(self.pending) > self.max_pending:
+            del self.pending[next(iter(self.pending))]
+
+    def reply(self, id, data, more=False):
+        p = self.pending.get(id)
+        if not p:
+            return
+
+        if p[0]:
+            p[2].append(data)
+            p[3] += len(data)
+            if p[3] > self.max_bytes or not data.startswith(b'{"status":"success"'):
+                p[0] = None
+                p[2] = []
+
+        if more:
+            return
+
+        p[1] -= 1
+        if p[1] > 0:
+            return
+
+        del self.pending[id]
+        if p[0]:
+            key, itype = p[0]
+            self.set(key, p[2], tag=itype)
@@ -11,7 +11,7 @@ class MyProcess(Process):
         return self
 
     def __exit__(self, type, value, traceback):
-        return self
+        return False
 
     def terminate(self):
         self.exit.set()
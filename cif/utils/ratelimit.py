@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, n=1):
+        self._refill()
+        if self.tokens < n:
+            return False
+
+        self.tokens -= n
+        return True
+
+    def remaining(self):
+        return int(self.tokens)
+
+    def retry_after(self, n=1):
+        return round(max(0, (n - self.tokens) / self.rate), 3)
+
+
+# one bucket per (token, message type), limits are {mtype: {'rate': per sec, 'burst': n}} with per token
+# overrides on top. buckets are kept lru so a flood of bogus tokens can't grow this without bound
+class RateLimiter(object):
+
+    def __init__(self, limits, tokens=None, exempt=None, max_buckets=10000):
+        self.limits = limits
+        self.tokens = tokens or {}
+        self.exempt = set(exempt or [])
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+
+    def _limit(self, token, mtype):
+        limit = self.tokens.get(token, {}).get(mtype, self.limits.get(mtype))
+        if not limit or not limit.get('rate'):
+            return
+
+        return limit
+
+    def bucket(self, token, mtype):
+        if token in self.exempt:
+            return
+
+        limit = self._limit(token, mtype)
+        if not limit:
+            return
+
+        k = (token, mtype)
+        b = self.buckets.get(k)
+        if b is None:
+            b = self.buckets[k] = TokenBucket(limit['rate'], limit.get('burst'))
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(k)
+
+        return b
+
+    def check(self, token, mtype):
+        # None when there's no limit, else the bucket (and whether this message fit in it)
+        b = self.bucket(token, mtype)
+        if b is None:
+            return True, None
+
+        return b.take(), b
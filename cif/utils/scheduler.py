@@ -0,0 +1,69 @@
+import time
+from collections import deque
+
+
+# weighted round robin over named queues, each round hands out up to <weight> items per queue so a queue
+# never takes more than its share of a round, however deep it gets
+class Scheduler(object):
+
+    def __init__(self, weights, max_queue=10000):
+        self.weights = {k: max(1, int(v)) for k, v in weights.items()}
+        self.max_queue = max_queue
+        self.queues = {k: deque() for k in self.weights}
+
+    def push(self, name, item):
+        self.queues[name].append(item)
+
+    def full(self, name):
+        return len(self.queues[name]) >= self.max_queue
+
+    def pending(self):
+        return any(self.queues.values())
+
+    def depth(self):
+        return {k: len(q) for k, q in self.queues.items()}
+
+    def round(self):
+        # highest weight first, so at equal depth the interactive queues go out ahead of the bulk ones
+        for name in sorted(self.weights, key=lambda k: -self.weights[k]):
+            q = self.queues[name]
+            for _ in range(min(self.weights[name], len(q))):
+                yield name, q.popleft()
+
+
+# requests handed to a downstream that haven't been answered yet, entries older than <timeout> seconds are
+# taken as lost (eg: the downstream restarted) so a dropped reply can't wedge it shut
+class InFlight(object):
+
+    def __init__(self, limit, timeout=60):
+        self.limit = int(limit)
+        self.timeout = timeout
+        self.sent = deque()
+        self.rejected = 0
+
+    def _expire(self):
+        cutoff = time.time() - self.timeout
+        while self.sent and self.sent[0] < cutoff:
+            self.sent.popleft()
+
+    def full(self):
+        if not self.limit:
+            return False
+
+        self._expire()
+        if len(self.sent) < self.limit:
+            return False
+
+        self.rejected += 1
+        return True
+
+    def add(self):
+        self.sent.append(time.time())
+
+    def done(self):
+        if self.sent:
+            self.sent.popleft()
+
+    def __len__(self):
+        self._expire()
+        return len(self.sent)
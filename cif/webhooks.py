@@ -9,6 +9,7 @@ import zmq
 from zmq.eventloop import zmqstream, ioloop
 
 from cif.constants import ROUTER_WEBHOOKS_ADDR
+from cif.utils import unpack_batch
 from cif.utils.manager import Manager as _Manager
 from .utils.process import MyProcess
 
@@ -65,16 +66,17 @@ class Webhooks(MyProcess):
             'text': "search: %s" % data.get('indicator')
         }
 
-    def send(self, data):
+    def send(self, message):
         if len(self.hooks) == 0:
             logger.info('no webhooks to send to... '
                         'is your webhooks.yml missing?')
             return
 
-        data = json.loads(data[0])
+        for data in unpack_batch(message):
+            if self.is_search(data):
+                self._send(data)
 
-        if not self.is_search(data):
-            return
+    def _send(self, data):
 
         for h in self.hooks:
             if h == 'slack':
@@ -0,0 +1,65 @@
+import logging
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import arrow
+
+from cif.store import Store
+
+logging.getLogger('cif.store').setLevel(logging.ERROR)
+
+
+def _populate(s, t, rows):
+    now = arrow.utcnow()
+    data = []
+    for n in range(0, rows):
+        ts = now.shift(seconds=-n).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        data.append({
+            'indicator': '10.%d.%d.%d' % ((n >> 16) & 255, (n >> 8) & 255, n & 255),
+            'itype': 'ipv4',
+            'tags': ['scanner', 'botnet'],
+            'provider': 'bench',
+            'group': 'everyone',
+            'confidence': 3,
+            'last_at': ts,
+            'reported_at': ts,
+            'message': 'c2NhbiBsb2c=',
+        })
+
+    for idx in range(0, rows, 5000):
+        s.handle_indicators_create(t, data[idx:idx + 5000])
+
+
+def main():
+    # python -m test.store.bench_search --rows 50000
+    p = ArgumentParser(prog='bench_search')
+    p.add_argument('--rows', type=int, default=50000)
+    p.add_argument('--runs', type=int, default=3)
+    args = p.parse_args()
+
+    dbfile = tempfile.mktemp()
+    with Store(store_type='sqlite', db_path=dbfile) as s:
+        s.token_handler.token_create_admin()
+        t = s.store.tokens.admin_exists()
+        _populate(s, t, args.rows)
+
+        t = s.store.tokens.read(t)
+        filters = {'itype': 'ipv4', 'confidence': 3, 'tags': 'scanner', 'limit': args.rows}
+
+        best = None
+        for _ in range(args.runs):
+            s1 = time.time()
+            rv = s.store.indicators.search(t, dict(filters))
+            e = time.time() - s1
+            best = e if best is None else min(best, e)
+
+        print('rows: %d  best: %0.2fs  %d rows/sec' % (len(rv), best, len(rv) / best))
+
+    if os.path.isfile(dbfile):
+        os.unlink(dbfile)
+
+
+if __name__ == '__main__':
+    main()
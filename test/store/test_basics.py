@@ -2,6 +2,7 @@
 import logging
 import os
 import tempfile
+import time
 from argparse import Namespace
 import pytest
 from cif.store import Store
@@ -41,3 +42,143 @@ def indicator():
 
 def test_store(store):
     assert store is not None
+
+
+def test_store_poll_timeout(store):
+    from cif.store.constants import STORE_POLL_MAX
+
+    # idle, nothing to flush
+    assert store._poll_timeout(time.time()) == STORE_POLL_MAX
+
+    # queued creates wake the loop when the flush is due, not before
+    store.create_queue['1234'] = {'count': 1, 'messages': []}
+    assert 0 < store._poll_timeout(time.time()) <= STORE_POLL_MAX
+    assert store._poll_timeout(time.time() - 3600) == 0
+
+
+def test_store_handle_socket(store):
+    import zmq
+    from cifsdk.msg import Msg
+
+    ctx = zmq.Context.instance()
+    s = ctx.socket(zmq.PAIR)
+    s.bind('inproc://store-handle-socket')
+    c = ctx.socket(zmq.PAIR)
+    c.connect('inproc://store-handle-socket')
+
+    handled = []
+    store.handle_message = lambda m, s=None: handled.append(m)
+
+    for n in range(5):
+        Msg(id=b'id', client_id=b'client', token='1234', mtype=Msg.PING, data='[]').send(c)
+
+    time.sleep(0.1)
+
+    # drains up to n messages per call, stops early once the socket is empty
+    store._handle_socket(s, 3)
+    assert len(handled) == 3
+
+    store._handle_socket(s, 10)
+    assert len(handled) == 5
+
+    s.close()
+    c.close()
+
+
+def test_store_readers(indicator):
+    import zmq
+    import ujson as json
+
+    dbfile = tempfile.mktemp()
+
+    with Store(store_type='sqlite', db_path=dbfile, role='writer') as w:
+        t = w.token_handler.token_create_admin()
+        w.handle_indicators_create(t, [indicator, dict(indicator, indicator='example.net')])
+
+        assert w.store.engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+
+        with Store(store_type='sqlite', db_path=dbfile, role='reader') as r:
+            ctx = zmq.Context.instance()
+            w.handoff = ctx.socket(zmq.PULL)
+            w.handoff.bind('inproc://store-handoff')
+            r.handoff = ctx.socket(zmq.PUSH)
+            r.handoff.connect('inproc://store-handoff')
+
+            x = r.handle_indicators_search(t, {'indicator': 'example.com'})
+            assert [i['indicator'] for i in x] == ['example.com']
+
+            # the reader's connection is read-only, writes are rejected
+            rejected = []
+            r.store.indicators.upsert(r.store.tokens.write(t), [dict(indicator, indicator='example.org')],
+                                      rejected=rejected)
+            assert len(rejected) == 1
+
+            # the reader's search log is queued, handed to the writer and written with its next flush
+            r._flush_search_queue()
+            w._handle_handoff()
+            w._flush_search_queue()
+            x = w.store.indicators.search(w.store.tokens.read(t), {'tags': 'search', 'nolog': 1})
+            assert [i['indicator'] for i in x] == ['example.com']
+
+            r.handoff.close()
+            w.handoff.close()
+
+    os.unlink(dbfile)
+
+
+def test_store_create_queue_ack(store, indicator):
+    import zmq
+    import ujson as json
+
+    t = store.store.tokens.admin_exists()
+    store.handle_indicators_create(t, [indicator, dict(indicator, indicator='example.net')])
+
+    ctx = zmq.Context.instance()
+    s = ctx.socket(zmq.PAIR)
+    s.bind('inproc://store-create-ack')
+    c = ctx.socket(zmq.PAIR)
+    c.connect('inproc://store-create-ack')
+
+    # single creates are queued, nothing goes back until the batch commits
+    for i in ['example.com', 'example.org']:
+        d = dict(indicator, indicator=i, last_at=arrow.utcnow().shift(minutes=1).isoformat())
+        store.handle_message((b'id', b'client', t, 'indicators_create', json.dumps([d])), s)
+
+    store._queue_indicator(b'id', t, dict(indicator, indicator='192.168.1', itype='ipv4'), b'client', s=s)
+    assert not c.poll(100)
+
+    store._flush_create_queue()
+
+    rv = [json.loads(c.recv_multipart()[-1]) for _ in range(3)]
+    counts = {'inserted': 1, 'updated': 1, 'rejected': 1}
+    assert rv[0] == rv[1] == {'status': 'success', 'data': counts}
+    assert rv[2] == {'status': 'failed', 'message': 'rejected', 'data': counts}
+
+    s.close()
+    c.close()
+
+
+def test_store_adaptive_flush(store, indicator):
+    from cif.store.constants import CREATE_QUEUE_MIN, CREATE_QUEUE_MAX
+
+    # slow commits shrink the batch, fast ones grow it back to the ceiling
+    store._adapt_batch(10, 10)
+    assert store.create_queue_batch == CREATE_QUEUE_MIN
+
+    for _ in range(50):
+        store._adapt_batch(0.00001, 1000)
+    assert store.create_queue_batch == CREATE_QUEUE_MAX
+
+    t = store.store.tokens.admin_exists()
+    for i in ['example.com', 'example.org']:
+        store._queue_indicator(b'id', t, dict(indicator, indicator=i), b'client', username='admin')
+
+    m = store.metrics()
+    assert m['create_queue_depth'] == {'admin': 2}
+    assert m['create_queue_count'] == 2
+
+    store.create_queue_batch = 1
+    store._flush_create_queue()
+
+    assert store.metrics()['create_queue_flush_latency'] > 0
+    assert len(list(store.store.indicators.search(store.store.tokens.read(t), {'indicator': 'example.org'}))) == 1
@@ -35,6 +35,15 @@ def test_indicators_search_fqdn(store, indicator):
         'indicator': 'example.com',
     })
 
+    # the search log is queued and written with the next flush
+    assert len(list(x)) == 0
+    store._flush_search_queue()
+
+    x = store.handle_indicators_search(t, {
+        'indicator': 'example.com',
+        'nolog': 1,
+    })
+
     assert len(list(x)) > 0
 
     indicator['tags'] = 'botnet'
@@ -170,3 +179,452 @@ def test_indicators_create_sha1(store, indicator):
     #     'nolog': 1
     # })
     # assert len(x) == 1
+
+
+def test_indicators_upsert_batch(store, indicator):
+    from sqlalchemy import event
+
+    t = store.store.tokens.admin_exists()
+
+    data = []
+    for n in range(0, 200):
+        i = dict(indicator)
+        i['indicator'] = 'example%d.com' % n
+        data.append(i)
+
+    store.handle_indicators_create(t, data)
+
+    selects = []
+
+    def _count(conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            selects.append(statement)
+
+    event.listen(store.store.engine, 'before_cursor_execute', _count)
+
+    last_at = arrow.utcnow().shift(minutes=1).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    for i in data:
+        i['last_at'] = last_at
+        i['tags'] = ['botnet']
+
+    store.handle_indicators_create(t, data)
+
+    event.remove(store.store.engine, 'before_cursor_execute', _count)
+
+    # one pre-fetch for the whole batch, not one per indicator
+    assert len(selects) < 5
+
+    x = store.handle_indicators_search(t, {
+        'indicator': 'example42.com',
+        'nolog': 1
+    })
+    assert len(x) == 1
+    assert x[0]['count'] == 2
+
+
+def test_indicators_upsert_native(indicator):
+    import os
+    import tempfile
+    from copy import deepcopy
+    from cif.store import Store
+
+    dbfile = tempfile.mktemp()
+
+    # tag-distinct duplicates are separate records in orm mode
+    dupe = dict(deepcopy(indicator), tags=['malware'], last_at='2020-01-01T00:00:00Z')
+    with Store(store_type='sqlite', db_path=dbfile) as s:
+        s.token_handler.token_create_admin()
+        t = s.store.tokens.admin_exists()
+        s.handle_indicators_create(t, [deepcopy(indicator), dupe])
+
+        x = s.handle_indicators_search(t, {'indicator': 'example.com', 'nolog': 1})
+        assert len(x) == 2
+
+    # .. and get merged when the natural key index is migrated in
+    with Store(store_type='sqlite', db_path=dbfile, upsert_mode='native') as s:
+        t = s.store.tokens.admin_exists()
+
+        x = s.handle_indicators_search(t, {'indicator': 'example.com', 'nolog': 1})
+        assert len(x) == 1
+        assert x[0]['count'] == 2
+        assert set(x[0]['tags']) == {'botnet', 'malware'}
+
+        data = [dict(deepcopy(indicator), indicator='example%d.com' % n) for n in range(0, 50)]
+        assert s.handle_indicators_create(t, deepcopy(data)) == 0
+
+        last_at = arrow.utcnow().shift(minutes=1).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        for i in data:
+            i['last_at'] = last_at
+            i['tags'] = ['phishing']
+
+        assert s.handle_indicators_create(t, data) == 50
+
+        x = s.handle_indicators_search(t, {'indicator': 'example42.com', 'nolog': 1})
+        assert len(x) == 1
+        assert x[0]['count'] == 2
+        assert set(x[0]['tags']) == {'botnet', 'phishing'}
+
+    if os.path.isfile(dbfile):
+        os.unlink(dbfile)
+
+
+def test_indicators_upsert_bisect(store, indicator):
+    t = store.store.tokens.admin_exists()
+    t = store.store.tokens.write(t)
+
+    data = []
+    for n in range(0, 20):
+        i = dict(indicator, indicator='192.168.1.%d' % n, itype='ipv4', tags=['scanner'])
+        data.append(i)
+
+    # the ipv4 column won't bind this, failing the whole batch
+    data[13]['indicator'] = '192.168.1'
+
+    rejected = []
+    store.store.indicators.upsert(t, data, rejected=rejected)
+
+    assert [r['indicator'] for r in rejected] == ['192.168.1']
+
+    x = store.handle_indicators_search(t['token'], {
+        'indicator': '192.168.1.0/24',
+        'nolog': 1,
+    })
+    assert len(x) == 19
+
+
+def test_indicators_search_serializer(store, indicator):
+    from cif.store.sqlite.indicator import Indicator
+
+    t = store.store.tokens.admin_exists()
+
+    indicator['message'] = 'aGVsbG8='
+    store.handle_indicators_create(t, indicator)
+
+    x = store.handle_indicators_search(t, {'indicator': 'example.com', 'nolog': 1})
+    assert len(x) == 1
+    assert 'message' not in x[0]
+
+    x = store.handle_indicators_search(t, {'indicator': 'example.com', 'nolog': 1, 'messages': 1})
+    assert len(x) == 1
+
+    # compiled projection matches the orm to_dict output
+    i = store.store.indicators.handle().query(Indicator).get(x[0]['id'])
+    assert x[0] == store.store.indicators.to_dict(i)
+    assert x[0]['last_at'].endswith('Z')
+
+
+def _query_plan(store, q):
+    return ' '.join(store.store.indicators._query_plan(q))
+
+
+def test_indicators_search_fqdn_subdomains(store, indicator):
+    import sqlite3
+
+    t = store.store.tokens.admin_exists()
+
+    data = [dict(indicator, indicator=i) for i in ['example.com', 'www.example.com', 'a.b.example.com',
+                                                     'badexample.com', 'example.com.evil.net']]
+    store.handle_indicators_create(t, data)
+
+    x = store.handle_indicators_search(t, {'indicator': 'example.com', 'nolog': 1})
+    assert sorted(i['indicator'] for i in x) == ['a.b.example.com', 'example.com', 'www.example.com']
+
+    q = store.store.indicators._search({'indicator': 'example.com'}, store.store.tokens.read(t))
+    assert 'ix_indicators_fqdn_fqdn_rev' in _query_plan(store, q)
+
+    # existing databases get the column backfilled
+    db = store.store.engine.url.database
+    conn = sqlite3.connect(db)
+    conn.execute('DROP INDEX ix_indicators_fqdn_fqdn_rev')
+    conn.execute('ALTER TABLE indicators_fqdn DROP COLUMN fqdn_rev')
+    conn.commit()
+    conn.close()
+
+    from cif.store.sqlite import SQLite
+    s = SQLite(db_path=db)
+    x = s.indicators.search(s.tokens.read(t), {'indicator': 'www.example.com'})
+    assert [i['indicator'] for i in x] == ['www.example.com']
+
+
+def test_indicators_search_ip_containment(store, indicator):
+    t = store.store.tokens.admin_exists()
+
+    data = [dict(indicator, indicator=i, itype='ipv4') for i in ['1.2.3.4', '1.2.3.0/24', '1.2.4.1', '5.6.7.8']]
+    data += [dict(indicator, indicator=i, itype='ipv6') for i in ['2001:4860:4860::8888', '2001:4860::/32']]
+    store.handle_indicators_create(t, data)
+
+    def _search(i):
+        x = store.handle_indicators_search(t, {'indicator': i, 'nolog': 1})
+        return sorted(r['indicator'] for r in x)
+
+    # stored prefixes containing the address, and addresses inside the prefix
+    assert _search('1.2.3.4') == ['1.2.3.0/24', '1.2.3.4']
+    assert _search('1.2.3.0/24') == ['1.2.3.0/24', '1.2.3.4']
+    assert _search('1.2.0.0/16') == ['1.2.3.0/24', '1.2.3.4', '1.2.4.1']
+    assert _search('1.2.3.5') == ['1.2.3.0/24']
+    assert _search('9.9.9.9') == []
+
+    assert _search('2001:4860:4860::8888') == ['2001:4860:4860::8888', '2001:4860::/32']
+    assert _search('2001:4860:1::1') == ['2001:4860::/32']
+    assert _search('2001:4861::/32') == []
+
+    q = store.store.indicators._search({'indicator': '1.2.3.4'}, store.store.tokens.read(t))
+    plan = _query_plan(store, q)
+    assert 'ix_indicators_ipv4_range' in plan
+    assert 'SCAN indicators_ipv4' not in plan
+
+    q = store.store.indicators._search({'indicator': '2001:4860::1'}, store.store.tokens.read(t))
+    assert 'SCAN indicators_ipv6' not in _query_plan(store, q)
+
+
+def test_indicators_search_fts(store, indicator):
+    import base64
+    from cif.store.sqlite import SQLite
+
+    t = store.store.tokens.admin_exists()
+
+    data = [
+        dict(indicator, indicator='example.com', asn_desc='Example Hosting LLC',
+             message=base64.b64encode(b'phishing kit found here').decode('utf-8')),
+        dict(indicator, indicator='example.net', asn_desc='Other Networks', description='known scanner'),
+    ]
+    store.handle_indicators_create(t, data)
+
+    # existing databases get the index backfilled
+    s = SQLite(db_path=store.store.engine.url.database, fts=True)
+    assert s.indicators.fts
+    token = s.tokens.read(t)
+
+    def _search(f):
+        return sorted(i['indicator'] for i in s.indicators.search(token, f))
+
+    assert _search({'indicator': 'phishing kit'}) == ['example.com']
+    assert _search({'indicator': 'scanner'}) == ['example.net']
+    assert _search({'asn_desc': 'hosting'}) == ['example.com']
+    assert _search({'asn_desc': 'nothing'}) == []
+
+    # kept up to date on upsert and delete
+    s.indicators.upsert(token, [dict(indicator, indicator='example.org', asn_desc='Hosting Co',
+                                     message=b'another kit')])
+    assert _search({'asn_desc': 'hosting'}) == ['example.com', 'example.org']
+    assert _search({'indicator': 'another kit'}) == ['example.org']
+
+    s.indicators.delete(token, {'indicator': 'example.org'})
+    assert _search({'asn_desc': 'hosting'}) == ['example.com']
+    assert s.engine.execute('SELECT count(*) FROM indicators_fts').scalar() == 2
+
+    q = s.indicators._search({'asn_desc': 'hosting'}, token)
+    assert 'indicators_fts VIRTUAL TABLE INDEX' in _query_plan(Namespace(store=s), q)
+
+    # opening the db without fts (eg: cif-store --token-create-*) leaves the index alone, searches keep using it
+    SQLite(db_path=store.store.engine.url.database, fts=False)
+    assert s.indicators.fts
+    assert _search({'asn_desc': 'hosting'}) == ['example.com']
+    assert _search({'indicator': 'phishing kit'}) == ['example.com']
+
+    # dropping it is explicit, searches fall back to LIKE
+    assert s.indicators.drop_fts()
+    assert not s.indicators.fts
+    assert _search({'asn_desc': 'hosting'}) == ['example.com']
+
+
+def test_indicators_fts_no_trigram():
+    import sqlite3
+    from cif.store.sqlite.migrations import create_fts
+
+    # sqlite < 3.34, other tokenizers would turn substring searches into whole word ones, LIKE is kept instead
+    class _Conn(object):
+        def __init__(self):
+            self.conn = sqlite3.connect(':memory:')
+
+        def execute(self, sql, *args):
+            if "tokenize='trigram'" in sql:
+                raise sqlite3.OperationalError('no such tokenizer: trigram')
+
+            return self.conn.execute(sql, *args)
+
+    conn = _Conn()
+    assert not create_fts(conn)
+    assert conn.execute("SELECT count(*) FROM sqlite_master WHERE name LIKE 'indicators_fts%'").fetchone()[0] == 0
+
+
+def test_indicators_search_tags(store, indicator):
+    t = store.store.tokens.admin_exists()
+
+    data = [
+        dict(indicator, indicator='example.com', tags=['malware', 'botnet', 'phishing']),
+        dict(indicator, indicator='example.net', tags=['malware']),
+        dict(indicator, indicator='example.org', tags=['pdns', 'malware']),
+    ]
+    store.handle_indicators_create(t, data)
+
+    def _search(f):
+        x = store.handle_indicators_search(t, dict(f, nolog=1))
+        return [i['indicator'] for i in x]
+
+    # one row per indicator, however many of its tags match
+    assert sorted(_search({'tags': 'malware,botnet,phishing'})) == ['example.com', 'example.net', 'example.org']
+    assert _search({'tags': 'malware+phishing'}) == ['example.com']
+    assert _search({'tags': 'malware phishing'}) == ['example.com']
+    assert sorted(_search({'tags': 'botnet+phishing,pdns'})) == ['example.com', 'example.org']
+
+    # pdns/search records are left out unless asked for
+    assert sorted(_search({'itype': 'fqdn'})) == ['example.com', 'example.net']
+
+    token = store.store.tokens.read(t)
+    for f in [{'tags': 'malware,botnet'}, {'tags': 'malware+botnet'}, {'itype': 'fqdn'}]:
+        plan = _query_plan(store, store.store.indicators._search(f, token))
+        assert 'USING COVERING INDEX ix_tags_indicator (tag=? AND indicator_id=?)' in plan
+        assert 'SCAN tags' not in plan
+
+
+def test_indicators_explain(store, indicator):
+    t = store.store.tokens.admin_exists()
+    store.handle_indicators_create(t, [dict(indicator, indicator='example.com'), dict(indicator, indicator='1.2.3.4',
+                                                                                     itype='ipv4')])
+
+    plans = {name: (' '.join(plan), flags) for name, plan, flags in store.store.indicators.explain()}
+    assert all(not flags for _, flags in plans.values())
+
+    # feeds walk the composite index in reported_at order, lookups start from the itype tables
+    assert 'ix_indicators_feed (group=? AND itype=? AND reported_at>?)' in plans['feed'][0]
+    assert 'ix_indicators_group_reported_at (group=? AND reported_at>?)' in plans['feed tags'][0]
+    assert plans['search ipv4'][0].startswith('MULTI-INDEX OR')
+    assert plans['search fqdn'][0].startswith('MULTI-INDEX OR')
+
+
+def test_indicators_search_stream(store, indicator):
+    import ujson as json
+    import zmq
+
+    t = store.store.tokens.admin_exists()
+    data = [dict(indicator, indicator='1.1.1.{}'.format(n), itype='ipv4') for n in range(1, 8)]
+    store.handle_indicators_create(t, data)
+
+    token = store.store.tokens.read(t)
+    chunks = list(store.store.indicators.search_chunks(token, {'itype': 'ipv4', 'nolog': 1}, size=3))
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert sum(chunks, []) == store.store.indicators.search(token, {'itype': 'ipv4', 'nolog': 1})
+
+    # the router side sees one envelope per chunk, then the end-of-stream marker
+    ctx = zmq.Context.instance()
+    store.router = ctx.socket(zmq.PAIR)
+    store.router.bind('inproc://store-stream')
+    router = ctx.socket(zmq.PAIR)
+    router.connect('inproc://store-stream')
+
+    m = (b'id', b'client', t, 'indicators_search', json.dumps({'itype': 'ipv4', 'nolog': 1, 'stream': 1}))
+    store.handle_message(m)
+
+    rv = []
+    while True:
+        d = json.loads(router.recv_multipart()[-1])
+        assert d['status'] == 'success'
+        rv += d['data']
+        if not d['more']:
+            break
+
+    assert sorted(i['indicator'] for i in rv) == sorted(i['indicator'] for i in data)
+
+    store.router.close()
+    router.close()
+
+
+def test_indicators_search_bulk(store, indicator):
+    t = store.store.tokens.admin_exists()
+
+    data = [dict(indicator, indicator=i) for i in ['example.com', 'www.example.com', 'example.net']]
+    data += [dict(indicator, indicator=i, itype='ipv4') for i in ['192.168.1.0/24', '192.168.1.1', '10.0.0.1']]
+    data += [dict(indicator, indicator='d41d8cd98f00b204e9800998ecf8427e', itype='md5')]
+    store.handle_indicators_create(t, data)
+
+    token = store.store.tokens.read(t)
+    store.store.indicators.upsert(dict(token, groups=['other']), [dict(indicator, indicator='example.org', group='other')])
+    x = store.store.indicators.search(token, [
+        {'indicator': 'example.com'},
+        {'indicator': 'example.org'},
+        {'indicator': '192.168.1.1'},
+        {'indicator': '10.0.0.0/24', 'limit': 1},
+        {'indicator': 'D41D8CD98F00B204E9800998ECF8427E'},
+        {'indicator': '2001:db8::1'},
+    ])
+
+    # keyed by input, subdomains and containing prefixes included, other groups left out
+    assert sorted(i['indicator'] for i in x['example.com']) == ['example.com', 'www.example.com']
+    assert x['example.org'] == []
+    assert sorted(i['indicator'] for i in x['192.168.1.1']) == ['192.168.1.0/24', '192.168.1.1']
+    assert [i['indicator'] for i in x['10.0.0.0/24']] == ['10.0.0.1']
+    assert [i['indicator'] for i in x['D41D8CD98F00B204E9800998ECF8427E']] == ['d41d8cd98f00b204e9800998ecf8427e']
+    assert x['2001:db8::1'] == []
+
+    # per key limits
+    x = store.store.indicators.search(token, [{'indicator': 'example.com'}, {'indicator': '192.168.1.1'}], limit=1)
+    assert [len(v) for v in x.values()] == [1, 1]
+
+
+def test_indicators_search_bulk_reader(indicator):
+    import os
+    import tempfile
+    from cif.store import Store
+
+    dbfile = tempfile.mktemp()
+    with Store(store_type='sqlite', db_path=dbfile, role='writer') as w:
+        t = w.token_handler.token_create_admin()
+        w.handle_indicators_create(t, [indicator, dict(indicator, indicator='example.net')])
+
+        with Store(store_type='sqlite', db_path=dbfile, role='reader') as r:
+            token = r.store.tokens.read(t)
+            conn = r.store.handle().connection().connection.connection
+
+            x = r.store.indicators.search(token, [{'indicator': 'example.com'}, {'indicator': 'example.net'}])
+
+            # the bulk search doesn't leave a transaction open, pinning the reader to its snapshot
+            assert not conn.in_transaction
+            assert sorted(x) == ['example.com', 'example.net']
+
+            w.handle_indicators_create(t, dict(indicator, indicator='c.com'))
+            x = r.store.indicators.search(token, {'indicator': 'c.com'})
+            assert [i['indicator'] for i in x] == ['c.com']
+
+    os.unlink(dbfile)
+
+
+def test_indicators_hash_backfill(store, indicator):
+    from cif.store.sqlite import SQLite
+
+    t = store.store.tokens.admin_exists()
+    md5 = 'd41d8cd98f00b204e9800998ecf8427e'
+    store.handle_indicators_create(t, dict(indicator, indicator=md5, itype='md5'))
+
+    # a db from before indicators_hash rows were written
+    store.store.engine.execute('DELETE FROM indicators_hash')
+    store.store.engine.execute('DROP INDEX ix_indicators_hash_indicator_id')
+
+    s = SQLite(db_path=store.store.engine.url.database)
+    token = s.tokens.read(t)
+    assert [i['indicator'] for i in s.indicators.search(token, {'indicator': md5.upper()})] == [md5]
+
+    # and the upsert finds it again instead of adding a duplicate
+    s.indicators.upsert(token, [dict(indicator, indicator=md5, itype='md5', count=2)])
+    assert s.engine.execute('SELECT count(*) FROM indicators').scalar() == 1
+
+
+def test_indicators_email_backfill(store, indicator):
+    from cif.store.sqlite import SQLite
+
+    t = store.store.tokens.admin_exists()
+    store.handle_indicators_create(t, dict(indicator, indicator='user@example.com', itype='email'))
+
+    # a db from before indicators_email rows (and email_rev) were written
+    store.store.engine.execute('DROP TABLE indicators_email')
+    store.store.engine.execute('CREATE TABLE indicators_email (id INTEGER PRIMARY KEY, email VARCHAR(255), '
+                               'indicator_id INTEGER REFERENCES indicators (id) ON DELETE CASCADE)')
+
+    s = SQLite(db_path=store.store.engine.url.database)
+    token = s.tokens.read(t)
+    assert [i['indicator'] for i in s.indicators.search(token, {'indicator': 'user@example.com'})] == \
+        ['user@example.com']
+
+    s.indicators.upsert(token, [dict(indicator, indicator='user@example.com', itype='email', count=2)])
+    assert s.engine.execute('SELECT count(*) FROM indicators').scalar() == 1
+    assert s.engine.execute('SELECT count(*) FROM indicators_email').scalar() == 1
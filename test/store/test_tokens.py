@@ -42,3 +42,157 @@ def test_tokens(store):
     assert store.store.tokens.admin(t)
     assert store.store.tokens.last_activity_at(t) is not None
     assert store.store.tokens.update_last_activity_at(t, datetime.now())
+
+
+def test_tokens_cache(store):
+    from cifsdk.exceptions import AuthError
+    tokens = store.store.tokens
+
+    t = tokens.admin_exists()
+    assert tokens.read(t)
+
+    # hits come from the cache, no query
+    search = tokens.search
+    tokens.search = None
+    assert tokens.admin(t)
+    tokens.search = search
+
+    # unknown tokens are cached as unknown
+    with pytest.raises(AuthError):
+        tokens.read('1234')
+
+    tokens.search = None
+    with pytest.raises(AuthError):
+        tokens.read('1234')
+    tokens.search = search
+
+    store.token_handler.handle_tokens_create(t, {'username': 'test', 'token': '1234', 'read': '1'})
+    assert tokens.read('1234')
+
+    with pytest.raises(AuthError):
+        tokens.write('1234')
+
+    store.token_handler.handle_tokens_edit(t, {'token': '1234', 'write': True, 'username': 'test'})
+    assert tokens.write('1234')
+
+    store.token_handler.handle_tokens_delete(t, {'username': 'test'})
+    with pytest.raises(AuthError):
+        tokens.read('1234')
+
+
+def test_tokens_cache_lru(store):
+    tokens = store.store.tokens
+    tokens._cache_size = 2
+
+    for t in ['a', 'b', 'c']:
+        tokens._cache_set(t, {'token': t})
+
+    assert list(tokens._cache) == ['b', 'c']
+
+    tokens._cache_set('d', {'token': 'd'}, ttl=-1)
+    assert tokens._cache_check('d') is False
+    assert 'd' not in tokens._cache
+
+
+def test_tokens_last_activity_batched(store):
+    tokens = store.store.tokens
+    t = tokens.admin_exists()
+
+    def _stored():
+        tokens.invalidate()
+        return list(tokens.search({'token': t}))[0]['last_activity_at']
+
+    before = _stored()
+    store._update_last_activity(t)
+    assert t in tokens._activity
+    assert _stored() == before
+
+    store._check_activity(force=True)
+    assert not tokens._activity
+    assert _stored() is not None and _stored() != before
+
+
+def test_tokens_hashed():
+    import sqlite3
+    from cif.store.sqlite.token import hash_token
+
+    dbfile = tempfile.mktemp()
+
+    # a pre-hash db, plaintext tokens only
+    conn = sqlite3.connect(dbfile)
+    conn.execute('CREATE TABLE tokens (id INTEGER PRIMARY KEY, username TEXT, token VARCHAR, expires DATETIME, '
+                 'read BOOLEAN, write BOOLEAN, revoked BOOLEAN, acl TEXT, groups TEXT, admin BOOLEAN, '
+                 'last_activity_at DATETIME)')
+    conn.execute("INSERT INTO tokens (username, token, read) VALUES ('old', '1234', 1)")
+    conn.commit()
+    conn.close()
+
+    with Store(store_type='sqlite', db_path=dbfile, hash_only=True) as s:
+        assert s.store.tokens.read('1234')['username'] == 'old'
+
+        t = s.token_handler.token_create_admin()
+        assert s.store.tokens.admin(t)
+
+        # only a truthy marker comes back once plaintext is gone
+        assert s.store.tokens.admin_exists() is True
+
+    conn = sqlite3.connect(dbfile)
+    assert conn.execute('SELECT count(*) FROM tokens WHERE token IS NOT NULL').fetchone()[0] == 0
+    assert conn.execute('SELECT token_hash FROM tokens WHERE username = ?', ('old',)).fetchone()[0] == \
+        hash_token('1234')
+
+    plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM tokens WHERE token_hash = ?', ('x',)).fetchall()
+    assert 'ix_tokens_token_hash' in str(plan)
+    conn.close()
+
+    os.unlink(dbfile)
+
+
+def test_tokens_key_warning(caplog):
+    dbfile = tempfile.mktemp()
+
+    with caplog.at_level(logging.WARNING, logger='cif.store.sqlite'):
+        with Store(store_type='sqlite', db_path=dbfile):
+            pass
+
+    assert 'CIF_STORE_TOKEN_KEY is not set' in caplog.text
+    assert 'CIF_STORE_TOKEN_HASH_ONLY=1' in caplog.text
+
+    os.unlink(dbfile)
+
+
+def test_tokens_cache_readers():
+    import time
+    import zmq
+    from cifsdk.exceptions import AuthError
+
+    dbfile = tempfile.mktemp()
+
+    with Store(store_type='sqlite', db_path=dbfile, role='writer') as w:
+        t = w.token_handler.token_create_admin()
+        w.token_handler.handle_tokens_create(t, {'username': 'test', 'token': '1234', 'read': '1'})
+
+        with Store(store_type='sqlite', db_path=dbfile, role='reader') as r:
+            ctx = zmq.Context.instance()
+            w.invalidations = ctx.socket(zmq.PUB)
+            w.invalidations.bind('inproc://store-invalidate')
+            w.token_handler.notify = w._publish_invalidate
+            r.invalidations = ctx.socket(zmq.SUB)
+            r.invalidations.setsockopt_string(zmq.SUBSCRIBE, '')
+            r.invalidations.connect('inproc://store-invalidate')
+            time.sleep(0.1)
+
+            assert r.store.tokens.read('1234')
+
+            # the delete lands on the writer, the reader's cached copy goes with it
+            w.token_handler.handle_tokens_delete(t, {'token': '1234'})
+            assert r.invalidations.poll(1000)
+            r._handle_invalidate()
+
+            with pytest.raises(AuthError):
+                r.store.tokens.read('1234')
+
+            r.invalidations.close()
+            w.invalidations.close()
+
+    os.unlink(dbfile)
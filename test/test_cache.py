@@ -0,0 +1,102 @@
+import time
+
+import arrow
+import ujson as json
+
+from cif.utils.cache import TTLCache, SearchCache
+
+
+def test_cache_ttl():
+    c = TTLCache(size=10, ttl=0.1)
+    assert c.get('a') is None
+
+    c.set('a', b'1')
+    assert c.get('a') == b'1'
+
+    time.sleep(0.15)
+    assert c.get('a') is None
+    assert c.metrics() == {'size': 0, 'hits': 1, 'misses': 2, 'invalidations': 0}
+
+
+def test_cache_lru():
+    c = TTLCache(size=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+
+    assert c.get('b') is None
+    assert c.get('a') == 1 and c.get('c') == 3
+
+
+def test_cache_invalidate():
+    c = TTLCache()
+    c.set('ipv4', 1, tag='ipv4')
+    c.set('fqdn', 2, tag='fqdn')
+    c.set('any', 3)
+
+    # untagged entries could hold any itype, they go with every write
+    assert c.invalidate(['ipv4']) == 2
+    assert c.get('fqdn') == 2
+    assert c.get('ipv4') is None and c.get('any') is None
+
+    c.set('fqdn', 4, tag='fqdn')
+    assert c.invalidate() == 1
+    assert not c.entries and not c.tags
+
+
+def _feed(now, days=1):
+    # what httpd sends for ?itype=ipv4&days=1, a reported_at range ending now to the second
+    now = arrow.get(now)
+    return json.dumps({'itype': 'ipv4', 'confidence': 3, 'limit': 500, 'reported_at': '{}Z,{}Z'.format(
+        now.replace(days=-days).format('YYYY-MM-DDTHH:mm:ss'), now.format('YYYY-MM-DDTHH:mm:ss'))})
+
+
+def test_search_cache_feeds():
+    c = SearchCache(ttl=30)
+    reply = b'{"status":"success","data":[]}'
+
+    pulls = [(b'fw1', '2026-10-18T09:00:01'), (b'fw2', '2026-10-18T09:00:04'), (b'fw3', '2026-10-18T09:00:09')]
+
+    queries = 0
+    for id, now in pulls:
+        key, itype = c.key('1234', _feed(now))
+        assert itype == 'ipv4'
+
+        if c.get(key) is None:
+            queries += 1
+            c.wait(id, key, itype)
+            c.reply(id, reply)
+
+    # pulls a few seconds apart share one store query
+    assert queries == 1
+    assert c.metrics()['hits'] == 2
+
+    assert c.key('1234', _feed('2026-10-18T09:00:01'))[0] != c.key('1234', _feed('2026-10-18T09:00:01', days=2))[0]
+    assert c.key('1234', _feed('2026-10-18T09:00:01'))[0] != c.key('5678', _feed('2026-10-18T09:00:01'))[0]
+
+
+def test_search_cache_replies():
+    c = SearchCache(ttl=30)
+    key, itype = c.key('1234', '{"indicator": "example.com", "stream": "1"}')
+    assert itype == 'fqdn'
+
+    # streamed replies are kept chunk by chunk
+    c.wait(b'a', key, itype)
+    chunks = [b'{"status":"success","data":[1],"more":true}', b'{"status":"success","data":[],"more":false}']
+    c.reply(b'a', chunks[0], more=True)
+    c.reply(b'a', chunks[1])
+    assert c.get(key) == chunks
+
+    # failures, and clients with two reads outstanding, aren't kept
+    c.invalidate()
+    c.wait(b'a', key, itype)
+    c.reply(b'a', b'{"status":"failed","message":"busy"}')
+    c.wait(b'b', key, itype)
+    c.wait(b'b')
+    c.reply(b'b', b'{"status":"success","data":[]}')
+    c.reply(b'b', b'{"status":"success","data":[]}')
+    assert c.get(key) is None and not c.pending
+
+    assert c.key('1234', '{"indicator": "example.com", "nocache": "1"}') == (None, None)
+    assert c.key('1234', '[{"indicator": "example.com"}, {"indicator": "example.net"}]') == (None, None)
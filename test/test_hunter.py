@@ -48,3 +48,18 @@ def test_hunter_plugins():
 
         rv = [i.__dict__() for i in rv]
         count += len(rv)
+
+
+def test_hunter_min_confidence():
+    from cif.hunter import below_min_confidence
+
+    assert below_min_confidence({'indicator': 'example.org', 'itype': 'fqdn', 'confidence': 0})
+    assert not below_min_confidence({'indicator': 'example.org', 'itype': 'fqdn', 'confidence': 3})
+
+    # an indicator without a confidence is below any cut-off, as it was when the router applied it
+    assert below_min_confidence({'indicator': 'example.org', 'itype': 'fqdn'})
+
+    # search filters (ranges, blanks) don't parse, they're hunted rather than failing the batch
+    assert not below_min_confidence({'indicator': 'example.org', 'itype': 'fqdn', 'confidence': '7,10'})
+    assert not below_min_confidence({'indicator': 'example.org', 'itype': 'fqdn', 'confidence': ''})
+    assert not below_min_confidence({'indicator': 'example.org', 'confidence': '7,10'})
@@ -0,0 +1,53 @@
+import time
+
+from cif.utils.ratelimit import RateLimiter, TokenBucket
+
+
+def test_token_bucket():
+    b = TokenBucket(10, burst=2)
+    assert b.take()
+    assert b.take()
+    assert not b.take()
+    assert b.remaining() == 0
+    assert 0 < b.retry_after() <= 0.1
+
+    time.sleep(0.15)
+    assert b.take()
+
+
+def test_rate_limiter():
+    r = RateLimiter({'indicators_search': {'rate': 1, 'burst': 1}},
+                    tokens={'sensor': {'indicators_search': {'rate': 1, 'burst': 3}}}, exempt=['hunter'])
+
+    assert r.check('1234', 'indicators_search')[0]
+    ok, b = r.check('1234', 'indicators_search')
+    assert not ok and b.remaining() == 0
+
+    # one token running dry doesn't touch the others
+    assert r.check('5678', 'indicators_search')[0]
+
+    assert [r.check('sensor', 'indicators_search')[0] for _ in range(4)] == [True, True, True, False]
+
+    # no limit for this mtype, or this token
+    assert r.check('1234', 'ping') == (True, None)
+    assert all(r.check('hunter', 'indicators_search')[0] for _ in range(5))
+
+    r.max_buckets = 2
+    r.check('abcd', 'indicators_search')
+    assert len(r.buckets) == 2
+
+
+def test_rate_limiter_defaults():
+    from cif.constants import ROUTER_RATE_LIMITS
+
+    # nothing configured, nothing throttled
+    r = RateLimiter(ROUTER_RATE_LIMITS)
+    for mtype in ['indicators_search', 'indicators_create', 'ping']:
+        assert all(r.check('1234', mtype) == (True, None) for _ in range(5000))
+
+    assert not r.buckets
+
+    # router.yml can still turn a limit on for one token
+    r = RateLimiter(ROUTER_RATE_LIMITS, tokens={'sensor': {'indicators_search': {'rate': 1, 'burst': 1}}})
+    assert [r.check('sensor', 'indicators_search')[0] for _ in range(2)] == [True, False]
+    assert r.check('1234', 'indicators_search') == (True, None)
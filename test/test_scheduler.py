@@ -0,0 +1,42 @@
+from cif.utils.scheduler import Scheduler, InFlight
+
+
+def test_scheduler():
+    s = Scheduler({'search': 4, 'hunter': 1}, max_queue=100)
+
+    for n in range(100):
+        s.push('hunter', n)
+
+    assert s.full('hunter')
+
+    for n in range(3):
+        s.push('search', n)
+
+    # a hunter storm still only gets its weight per round
+    rv = list(s.round())
+    assert rv == [('search', 0), ('search', 1), ('search', 2), ('hunter', 0)]
+    assert s.depth() == {'search': 0, 'hunter': 99}
+
+    assert list(s.round()) == [('hunter', 1)]
+    assert s.pending()
+
+
+def test_inflight():
+    import time
+
+    f = InFlight(2, timeout=0.1)
+    f.add()
+    f.add()
+    assert f.full()
+    assert f.rejected == 1
+
+    f.done()
+    assert not f.full()
+    assert len(f) == 1
+
+    # unanswered requests stop counting once they time out
+    f.add()
+    time.sleep(0.2)
+    assert len(f) == 0
+
+    assert not InFlight(0).full()
@@ -4,3 +4,20 @@ from cif.webhooks import Webhooks
 def test_webhooks():
     with Webhooks(test=True) as r:
         pass
+
+
+def test_webhooks_batch():
+    import ujson as json
+
+    with Webhooks(test=True) as w:
+        w.hooks = {'test': 'http://localhost'}
+        sent = []
+        w._send = sent.append
+
+        # gatherer batches come through as one frame, searches as a dict
+        w.send([
+            json.dumps([{'indicator': 'example.com', 'tags': ['search']}, {'indicator': 'example.net', 'tags': ['malware']}]),
+            json.dumps({'indicator': 'example.org', 'limit': 1}),
+        ])
+
+        assert [d['indicator'] for d in sent] == ['example.com', 'example.org']